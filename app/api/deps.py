@@ -1,11 +1,6 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-from app.config import settings
+from app.db.client import get_database
+from app.storage import StorageEngine
 
 
-async def get_db() -> AsyncIOMotorClient:
-    try:
-        client = AsyncIOMotorClient(settings.mongo_uri)
-        db = client[settings.db_name]
-        yield db
-    finally:
-        client.close()
+async def get_db() -> StorageEngine:
+    return get_database()
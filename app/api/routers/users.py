@@ -1,55 +1,149 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, HTTPException
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from starlette import status
-from starlette.authentication import requires
 from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from app import crud, schemas
 from app.api import deps
+from app.storage import StorageEngine
 
+from app.utils.auth import requires
+from app.utils.conditional import (
+    conditional_response, entity_tag, expected_version, last_modified, list_entity_tag,
+)
+from app.utils.export import export_ndjson
+from app.utils.hashing import password_hasher
+from app.utils.responses import FastJSONResponse, shaped_response
+from app.utils.throttling import login_throttle
+from app.utils.write_behind import last_login_buffer
 from app.utils.user_utils import (
-    get_hashed_password, authenticate_user, create_access_token,
-    create_refresh_token, refresh_token_helper,
+    access_token_claims, authenticate_user, create_access_token,
+    create_refresh_token, introspect_tokens, refresh_token_helper,
 )
 
-router = APIRouter(prefix='/users', tags=['users'])
+router = APIRouter(prefix='/users', tags=['users'], default_response_class=FastJSONResponse)
+user_not_found_exception = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="User not found",
+    )
 
 
 @router.get(
     "/profile/",
     response_model=schemas.RetrieveUser,
-    description="Retrieve profile of authorized user.",
+    description="Retrieve profile of authorized user. Supports conditional requests "
+                "with `If-None-Match` / `If-Modified-Since`.",
 )
 @requires('authenticated')
-async def get_authorized_user(request: Request, db: AsyncIOMotorClient = Depends(deps.get_db)):
+async def get_authorized_user(
+        request: Request,
+        response: Response,
+        db: StorageEngine = Depends(deps.get_db),
+):
     users_collection = db["users"]
     user = await crud.user.get(request.user.id, users_collection)
-    return user
+    if user is None:
+        raise user_not_found_exception
+    not_modified = conditional_response(request, response, entity_tag(user), last_modified(user))
+    return not_modified or shaped_response(user, response)
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    description="Stream users matching the filters as newline-delimited JSON. "
+                "Usage is allowed only for Admin role. With `with_cursor` every line carries "
+                "a `_cursor` to pass as `cursor` to resume the export after it.",
+)
+@requires(['authenticated', 'admin'])
+async def export_users(
+        request: Request,
+        role: Optional[schemas.UserRole] = None,
+        is_active: Optional[bool] = None,
+        first_name: Optional[str] = Query(None, max_length=24, description="first name prefix"),
+        last_name: Optional[str] = Query(None, max_length=24, description="last name prefix"),
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+        with_cursor: bool = False,
+        batch_size: int = Query(1000, ge=1, le=10000),
+        db: StorageEngine = Depends(deps.get_db),
+):
+    users_collection = db["users"]
+    where = crud.user.filter(
+        role=role,
+        is_active=is_active,
+        first_name=first_name,
+        last_name=last_name,
+        created_from=created_from,
+        created_to=created_to,
+    )
+    users = crud.user.iterate(users_collection, where, after=cursor, batch_size=batch_size)
+    return StreamingResponse(
+        export_ndjson(crud.user, users, with_cursor=with_cursor),
+        media_type="application/x-ndjson",
+    )
 
 
 @router.get(
     "/{user_id}/",
     response_model=schemas.RetrieveUser,
-    description="Retrieve profile by user ID.",
+    description="Retrieve profile by user ID. Supports conditional requests "
+                "with `If-None-Match` / `If-Modified-Since`.",
 )
-async def get_user_by_id(user_id: str, db: AsyncIOMotorClient = Depends(deps.get_db)):
+async def get_user_by_id(
+        user_id: str,
+        request: Request,
+        response: Response,
+        db: StorageEngine = Depends(deps.get_db),
+):
     users_collection = db["users"]
     user = await crud.user.get(user_id, users_collection)
-    return user
+    if user is None:
+        raise user_not_found_exception
+    not_modified = conditional_response(request, response, entity_tag(user), last_modified(user))
+    return not_modified or shaped_response(user, response)
 
 
 @router.get(
     "/",
     response_model=List[schemas.RetrieveUser],
-    description="Retrieve list of users.",
+    description="Retrieve list of users, optionally filtered. Name filters are "
+                "case-insensitive prefixes. When more users may follow, the `X-Next-Cursor` "
+                "response header holds the `cursor` of the next page. With `with_total` the "
+                "`X-Total-Count` header holds the (approximate) number of matching users. "
+                "Supports conditional requests with `If-None-Match`.",
 )
-async def get_users(skip: int = 0, limit: int = 12, db: AsyncIOMotorClient = Depends(deps.get_db)):
+async def get_users(
+        request: Request,
+        response: Response,
+        role: Optional[schemas.UserRole] = None,
+        is_active: Optional[bool] = None,
+        first_name: Optional[str] = Query(None, max_length=24, description="first name prefix"),
+        last_name: Optional[str] = Query(None, max_length=24, description="last name prefix"),
+        cursor: Optional[str] = None,
+        limit: int = Query(12, ge=1, le=1000),
+        skip: int = Query(0, ge=0, deprecated=True),
+        with_total: bool = False,
+        db: StorageEngine = Depends(deps.get_db),
+):
     users_collection = db["users"]
-    users = await crud.user.get_multi(users_collection, skip=skip, limit=limit)
-    return users
+    where = crud.user.filter(
+        role=role, is_active=is_active, first_name=first_name, last_name=last_name,
+    )
+    users = await crud.user.get_multi(
+        users_collection, skip=skip, limit=limit, after=cursor, where=where,
+    )
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = crud.user.next_cursor(users[-1])
+    if with_total:
+        response.headers["X-Total-Count"] = str(await crud.user.count(users_collection, where))
+    not_modified = conditional_response(request, response, list_entity_tag(users))
+    return not_modified or shaped_response(users, response)
 
 
 @router.post(
@@ -60,63 +154,132 @@ async def get_users(skip: int = 0, limit: int = 12, db: AsyncIOMotorClient = Dep
 )
 async def create_user(
         user: schemas.CreateUserRequest,
-        db: AsyncIOMotorClient = Depends(deps.get_db),
+        db: StorageEngine = Depends(deps.get_db),
 ):
     users_collection = db["users"]
     raw_user = user.dict()
-    raw_user['hashed_pass'] = get_hashed_password(raw_user.pop('password'))
+    raw_user['hashed_pass'] = await password_hasher.hash(raw_user.pop('password'))
     raw_user['id'] = str(uuid4())
     user_obj = schemas.CreateUser(**raw_user)
     created_user = await crud.user.create(user_obj, users_collection)
     return created_user
 
 
+@router.post(
+    "/batch-get",
+    response_model=List[schemas.RetrieveUser],
+    description="Retrieve many profiles by user IDs in one query. Unknown IDs are skipped.",
+)
+async def get_users_by_ids(
+        data: schemas.BatchGetUsers,
+        db: StorageEngine = Depends(deps.get_db),
+):
+    users_collection = db["users"]
+    users = await crud.user.get_many(list(dict.fromkeys(data.ids)), users_collection)
+    return shaped_response(users)
+
+
+@router.post(
+    "/bulk",
+    response_model=schemas.BulkCreateUsersResponse,
+    description="Create many users at once. Usage is allowed only for Admin role. "
+                "Rejected items are reported by their index in the request.",
+)
+@requires(['authenticated', 'admin'])
+async def create_users(
+        data: schemas.BulkCreateUsersRequest,
+        request: Request,
+        db: StorageEngine = Depends(deps.get_db),
+):
+    users_collection = db["users"]
+    hashes = await password_hasher.hash_many([user.password for user in data.users])
+    errors = []
+    user_objs = []
+    indexes = []
+    for index, (user, hashed_pass) in enumerate(zip(data.users, hashes)):
+        if isinstance(hashed_pass, HTTPException):
+            errors.append(schemas.BulkItemError(index=index, detail=hashed_pass.detail))
+            continue
+        raw_user = user.dict(exclude={'password'})
+        raw_user['hashed_pass'] = hashed_pass
+        raw_user['id'] = str(uuid4())
+        user_objs.append(schemas.CreateUser(**raw_user))
+        indexes.append(index)
+    created_users, insert_errors = [], {}
+    if user_objs:
+        created_users, insert_errors = await crud.user.create_many(user_objs, users_collection)
+    errors.extend(
+        schemas.BulkItemError(index=indexes[position], detail=detail)
+        for position, detail in insert_errors.items()
+    )
+    errors.sort(key=lambda error: error.index)
+    return {"created": created_users, "errors": errors}
+
+
 @router.patch(
     "/",
     response_model=schemas.RetrieveUser,
-    description="Edit profile of authorized user",
+    description="Edit profile of authorized user. With `If-Match` the update only "
+                "applies to that version of the profile, otherwise 412 is returned.",
 )
 @requires('authenticated')
 async def update_authorized_user(
         data_to_update: schemas.UpdateUserRequest,
         request: Request,
-        db: AsyncIOMotorClient = Depends(deps.get_db),
+        response: Response,
+        db: StorageEngine = Depends(deps.get_db),
 ):
     users_collection = db["users"]
+    version = expected_version(request, request.user.id)
     raw_user = data_to_update.dict(exclude_unset=True)
     if password := raw_user.pop('password', None):
-        raw_user['hashed_pass'] = get_hashed_password(password)
+        raw_user['hashed_pass'] = await password_hasher.hash(password)
     user_obj = schemas.UpdateUser(**raw_user)
-    created_user = await crud.user.update(request.user.id, user_obj, users_collection)
+    created_user = await crud.user.update(
+        request.user.id, user_obj, users_collection, expected_version=version,
+    )
+    if created_user is not None:
+        response.headers["ETag"] = entity_tag(created_user)
     return created_user
 
 
 @router.patch(
     "/{user_id}/",
     response_model=schemas.RetrieveUser,
-    description="Edit user's profile by ID. Usage is allowed only for Admin role.",
+    description="Edit user's profile by ID. Usage is allowed only for Admin role. "
+                "With `If-Match` the update only applies to that version of the profile, "
+                "otherwise 412 is returned.",
 )
 @requires(['authenticated', 'admin'])
 async def update_user_by_id(
         user_id: str,
         data_to_update: schemas.BaseUpdateUser,
         request: Request,
-        db: AsyncIOMotorClient = Depends(deps.get_db),
+        response: Response,
+        db: StorageEngine = Depends(deps.get_db),
 ):
     users_collection = db["users"]
-    created_user = await crud.user.update(user_id, data_to_update, users_collection)
+    created_user = await crud.user.update(
+        user_id, data_to_update, users_collection,
+        expected_version=expected_version(request, user_id),
+    )
+    if created_user is not None:
+        response.headers["ETag"] = entity_tag(created_user)
     return created_user
 
 
 @router.post(
     "/token",
     response_model=schemas.TokenSchema,
-    description="Retrieve authorization tokens. Common JWT auth flow.",
+    description="Retrieve authorization tokens. Common JWT auth flow. Attempts are "
+                "limited per user id and client IP, above that the response is a 429.",
 )
 async def login(
     login_data: schemas.LoginUser,
-    db: AsyncIOMotorClient = Depends(deps.get_db),
+    request: Request,
+    db: StorageEngine = Depends(deps.get_db),
 ):
+    await login_throttle.check(login_data.id, request.client.host if request.client else None)
     users_collection = db["users"]
     user = await authenticate_user(login_data.id, login_data.password, users_collection)
     if not user:
@@ -125,11 +288,27 @@ async def login(
             detail="Incorrect user_id or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = create_access_token(user.id)
+    last_login_buffer.record(user.id)
+    access_token = create_access_token(user.id, access_token_claims(user))
     refresh_token = create_refresh_token(user.id)
     return {"access_token": access_token, "refresh_token": refresh_token}
 
 
+@router.post(
+    "/introspect",
+    response_model=schemas.IntrospectTokensResponse,
+    response_model_exclude_none=True,
+    description="Validate many access tokens at once, e.g. from a gateway. Each token gets "
+                "`active` and, when active, the current claims of its user, in request order.",
+)
+async def introspect(
+    data: schemas.IntrospectTokens,
+    db: StorageEngine = Depends(deps.get_db),
+):
+    users_collection = db["users"]
+    return {"tokens": await introspect_tokens(data.tokens, users_collection)}
+
+
 @router.post(
     "/refresh_token",
     response_model=schemas.TokenSchema,
@@ -137,7 +316,7 @@ async def login(
 )
 async def get_new_token_with_refresh_token(
     r_token: schemas.RefreshTokenSchema,
-    db: AsyncIOMotorClient = Depends(deps.get_db),
+    db: StorageEngine = Depends(deps.get_db),
 ):
     users_collection = db["users"]
     return await refresh_token_helper(r_token.refresh_token, users_collection)
@@ -151,7 +330,7 @@ async def get_new_token_with_refresh_token(
 @requires('authenticated')
 async def remove_authorized_user(
         request: Request,
-        db: AsyncIOMotorClient = Depends(deps.get_db),
+        db: StorageEngine = Depends(deps.get_db),
 ):
     users_collection = db["users"]
     await crud.user.remove(request.user.id, users_collection)
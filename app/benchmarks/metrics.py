@@ -0,0 +1,86 @@
+"""
+Per-request cost of the metrics instrumentation.
+
+    $ python -m app.benchmarks.metrics --requests 100000
+
+Calls a minimal ASGI app directly, with and without `MetricsMiddleware`, and
+reports the added time per request, along with the cost of one histogram
+observation. The exit status is 1 when the overhead is above `--budget`
+microseconds.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from app.utils.metrics import Histogram, MetricsMiddleware
+
+
+async def endpoint():
+    pass
+
+
+class Route:
+    path = "/users/{user_id}/"
+    endpoint = endpoint
+
+
+class App:
+    """ Stands for a routed application: sets the matched endpoint and responds """
+    routes = [Route]
+
+    async def __call__(self, scope, receive, send):
+        scope["endpoint"] = endpoint
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def receive():
+    return {"type": "http.request"}
+
+
+async def send(message):
+    pass
+
+
+async def measure(app, requests: int) -> float:
+    """ Best per-request time of 5 runs, in microseconds """
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(requests):
+            scope = {"type": "http", "method": "GET", "path": "/users/1/", "app": App}
+            await app(scope, receive, send)
+        best = min(best, time.perf_counter() - started)
+    return best / requests * 1_000_000
+
+
+def measure_observe(observations: int) -> float:
+    histogram = Histogram("benchmark_seconds", "Benchmark.", ("route",))
+    started = time.perf_counter()
+    for _ in range(observations):
+        histogram.observe(0.003, "/users/{user_id}/")
+    return (time.perf_counter() - started) / observations * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--budget', type=float, default=5.0, help="allowed overhead, microseconds")
+    args = parser.parse_args(argv)
+
+    app = App()
+    bare = asyncio.run(measure(app, args.requests))
+    instrumented = asyncio.run(measure(MetricsMiddleware(app), args.requests))
+    overhead = instrumented - bare
+    print(f"{'bare app':<24}{bare:>8.2f} us/request")
+    print(f"{'with MetricsMiddleware':<24}{instrumented:>8.2f} us/request")
+    print(f"{'overhead':<24}{overhead:>8.2f} us/request")
+    print(f"{'histogram observe':<24}{measure_observe(args.requests):>8.2f} us")
+    if overhead > args.budget:
+        print(f"overhead above the {args.budget} us budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Throughput and latency of the user service hot paths, driven in-process.
+
+    $ python -m app.benchmarks.routes --requests 500 --concurrency 16
+
+The ASGI app is called through httpx, without a network hop. With the default
+`--engine memory` (`app.storage.memory`) the numbers cover the middleware,
+routing, CRUD and serialization code and nothing else; `--engine sql` and
+`--engine mongo` run the same workload on a scratch SQL database (`--sql-url`)
+or on the `<db_name>_benchmark` MongoDB database, which are emptied first. Results
+are written as JSON to `--output` and compared with `--baseline`: a route
+regresses when its throughput drops, or its p95 latency grows, by more than
+`--threshold` (0.25 is 25%). The exit status is 1 on any regression.
+
+Routes bound by bcrypt (`/users/token`, `POST /users/`) run `--slow-requests`
+requests, so a run stays within seconds. The login throttle is disabled for
+the run, as all requests come from one client address.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import sqlalchemy
+
+from app import crud, schemas
+from app.config import settings
+from app.db import client
+from app.db.user import create_user_index, metadata
+from app.storage import StorageEngine
+from app.storage.memory import MemoryEngine
+from app.storage.motor import MotorEngine
+from app.storage.sql import SQLEngine
+from app.utils.hashing import get_hashed_password
+from app.utils.middlewares import principal_cache
+from app.utils.throttling import login_throttle
+from app.utils.user_utils import create_access_token, create_refresh_token, token_versions
+
+PASSWORD = "benchmark1"
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+@dataclass
+class Route:
+    name: str
+    call: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+    slow: bool = False
+
+
+def make_users(count: int, hashed_pass: str) -> List[schemas.CreateUser]:
+    now = datetime(2023, 4, 10, 10, 28, 48, 759000)
+    return [
+        schemas.CreateUser(
+            first_name="John",
+            last_name=f"Doe{index}",
+            role=schemas.UserRole.admin if index == 0 else schemas.UserRole.simple_mortal,
+            id=f"91dba2e3-d98d-4abe-ab66-{index:012d}",
+            created_at=now + timedelta(seconds=index),
+            last_login=now + timedelta(seconds=index),
+            hashed_pass=hashed_pass,
+        )
+        for index in range(count)
+    ]
+
+
+def make_routes(users: List[schemas.CreateUser]) -> List[Route]:
+    def user_id(n: int) -> str:
+        return users[n % len(users)].id
+
+    def auth(n: int) -> dict:
+        return {"Authorization": f"Bearer {create_access_token(user_id(n))}"}
+
+    # tokens are issued up front: their cost is not part of the measured requests
+    headers = [auth(n) for n in range(min(len(users), 256))]
+    refresh_tokens = [create_refresh_token(user_id(n)) for n in range(len(headers))]
+
+    return [
+        Route(
+            "POST /users/token",
+            lambda http, n: http.post("/users/token", json={"id": user_id(n), "password": PASSWORD}),
+            slow=True,
+        ),
+        Route(
+            "POST /users/refresh_token",
+            lambda http, n: http.post(
+                "/users/refresh_token", json={"refresh_token": refresh_tokens[n % len(refresh_tokens)]},
+            ),
+        ),
+        Route(
+            "GET /users/profile/",
+            lambda http, n: http.get("/users/profile/", headers=headers[n % len(headers)]),
+        ),
+        Route(
+            "GET /users/{id}/",
+            lambda http, n: http.get(f"/users/{user_id(n + 1)}/", headers=headers[n % len(headers)]),
+        ),
+        Route(
+            "GET /users/",
+            lambda http, n: http.get(
+                "/users/", params={"limit": 50, "skip": n % 10 * 50}, headers=headers[n % len(headers)],
+            ),
+        ),
+        Route(
+            "POST /users/",
+            lambda http, n: http.post(
+                "/users/", json={"first_name": "Jane", "last_name": "Doe", "password": PASSWORD},
+            ),
+            slow=True,
+        ),
+    ]
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def run_route(http: httpx.AsyncClient, route: Route, requests: int, concurrency: int) -> dict:
+    latencies: List[float] = []
+    failures = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal failures
+        for n in counter:
+            started = time.perf_counter()
+            response = await route.call(http, n)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "failures": failures,
+        "throughput": round(requests / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def make_engine(args) -> StorageEngine:
+    if args.engine == 'sql':
+        path = sqlalchemy.engine.make_url(args.sql_url).database
+        if args.sql_url.startswith('sqlite') and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SQLEngine(args.sql_url, metadata, **client.sql_pool_options(args.sql_url))
+    if args.engine == 'mongo':
+        return MotorEngine(client.connect()[f"{settings.db_name}_benchmark"])
+    return MemoryEngine(settings.db_name)
+
+
+async def run(args) -> Dict[str, dict]:
+    from app.main import app
+
+    engine = make_engine(args)
+    previous, client._database = client._database, engine
+    # every request comes from one address, the throttle would answer 429s
+    limits = login_throttle.limits
+    login_throttle.limits = {kind: (0, rate) for kind, (_, rate) in limits.items()}
+    try:
+        await engine.drop()
+        await create_user_index(engine)
+        users = make_users(args.users, get_hashed_password(PASSWORD))
+        await crud.user.create_many(users, client.get_database()["users"])
+        results = {}
+        async with httpx.AsyncClient(app=app, base_url="http://benchmark") as http:
+            for route in make_routes(users):
+                requests = args.slow_requests if route.slow else args.requests
+                # one untimed round warms up caches and lazy imports
+                await run_route(http, route, min(requests, args.concurrency), args.concurrency)
+                results[route.name] = await run_route(http, route, requests, args.concurrency)
+        return results
+    finally:
+        await engine.disconnect()
+        client._database = previous
+        if crud.user.cache is not None:
+            await crud.user.cache.clear()
+        principal_cache.clear()
+        token_versions.clear()
+        login_throttle.limits = limits
+        await login_throttle.backend.clear()
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {result['throughput']} < {base['throughput']}")
+        if result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms > {base['p95_ms']}ms")
+    return regressions
+
+
+def load_baseline(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path: str, results: Dict[str, dict], args):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "settings": {
+            "engine": args.engine,
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "password_hash_executor": settings.password_hash_executor,
+            "stateless_access_tokens": settings.stateless_access_tokens,
+        },
+        "routes": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engine', choices=['memory', 'sql', 'mongo'], default='memory')
+    parser.add_argument('--sql-url', default='sqlite:///tmp/benchmarks/users.db')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--slow-requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--output', default=os.path.join('tmp', 'benchmarks', 'routes.json'))
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    print(f"{'route':<28}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:<28}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+            f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['failures']:>8}"
+        )
+    save(args.output, results, args)
+    if args.update_baseline:
+        save(args.baseline, results, args)
+        return
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"no baseline at {args.baseline}, run with --update-baseline to create it")
+        return
+    engine = baseline["settings"].get("engine", "memory")
+    if engine != args.engine:
+        print(f"baseline was recorded with --engine {engine}, pass a --baseline of this engine")
+        return
+    regressions = compare(results, baseline["routes"], args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions or any(result["failures"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
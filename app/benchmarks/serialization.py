@@ -0,0 +1,81 @@
+"""
+Per-item cost of rendering user lists, before and after the shaped response path.
+
+    $ python -m app.benchmarks.serialization --items 1000 --rounds 50
+
+* `response_model`: what FastAPI does for a returned list of models:
+  validation against `List[RetrieveUser]`, `jsonable_encoder`, stdlib json
+* `shaped`: `shaped_response`, i.e. `.dict()` per model and `FastJSONResponse`
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from starlette.responses import JSONResponse
+
+from app import crud, schemas
+from app.utils.responses import shaped_response
+
+
+def make_users(count: int) -> List[schemas.RetrieveUser]:
+    now = datetime(2023, 4, 10, 10, 28, 48, 759000)
+    return [
+        crud.user.from_db({
+            "first_name": "John",
+            "last_name": f"Doe{index}",
+            "role": "simple mortal",
+            "id": f"91dba2e3-d98d-4abe-ab66-{index:012d}",
+            "is_active": True,
+            "created_at": now + timedelta(seconds=index),
+            "last_login": now + timedelta(seconds=index),
+            "updated_at": now + timedelta(seconds=index),
+            "version": 1,
+        })
+        for index in range(count)
+    ]
+
+
+def response_model_path(users: List[schemas.RetrieveUser]) -> bytes:
+    field = create_response_field(name="Response_get_users", type_=List[schemas.RetrieveUser])
+    content = asyncio.run(serialize_response(field=field, response_content=users))
+    return JSONResponse(content).body
+
+
+def shaped_path(users: List[schemas.RetrieveUser]) -> bytes:
+    return shaped_response(users).body
+
+
+def measure(render: Callable[[list], bytes], users: list, rounds: int) -> float:
+    """ Best per-item time over `rounds`, in microseconds """
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        render(users)
+        best = min(best, time.perf_counter() - started)
+    return best / len(users) * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    users = make_users(args.items)
+    # both paths must produce the same document
+    assert json.loads(response_model_path(users[:3])) == json.loads(shaped_path(users[:3]))
+    before = measure(response_model_path, users, args.rounds)
+    after = measure(shaped_path, users, args.rounds)
+    print(f"{'path':<16}{'us/item':>10}")
+    print(f"{'response_model':<16}{before:>10.2f}")
+    print(f"{'shaped':<16}{after:>10.2f}")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
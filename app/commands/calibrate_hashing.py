@@ -0,0 +1,32 @@
+"""
+Pick the bcrypt cost for a target verify latency on this machine.
+
+    $ python -m app.commands.calibrate_hashing --target-ms 250
+
+Prints the verify time of each cost around the pick, and the setting to use.
+Setting `PASSWORD_HASH_TARGET_MS` instead calibrates on every startup.
+"""
+import argparse
+
+from app.config import settings
+from app.utils.hashing import BCRYPT_MAX_ROUNDS, calibrate_rounds, measure_verify
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Calibrate the bcrypt cost.")
+    parser.add_argument('--target-ms', type=float, default=settings.password_hash_target_ms or 250)
+    parser.add_argument('--min-rounds', type=int, default=settings.password_hash_min_rounds)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rounds = calibrate_rounds(args.target_ms / 1000, args.min_rounds)
+    for candidate in range(max(args.min_rounds, rounds - 1), min(BCRYPT_MAX_ROUNDS, rounds + 1) + 1):
+        marker = " <-" if candidate == rounds else ""
+        print(f"rounds {candidate:>2}: {measure_verify(candidate, repeat=1) * 1000:8.1f} ms{marker}")
+    print(f"PASSWORD_HASH_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Export users as newline-delimited JSON.
+
+    $ python -m app.commands.export_users --output users.ndjson --role admin
+
+The cursor after the last exported user is printed to stderr; pass it as
+`--after` to resume an interrupted export.
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime
+
+from app import crud
+from app.db import client
+from app.schemas import UserRole
+from app.utils.export import export_ndjson
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export users as NDJSON.")
+    parser.add_argument('--output', default='-', help="output file, '-' for stdout")
+    parser.add_argument('--role', type=UserRole, choices=list(UserRole))
+    parser.add_argument('--is-active', type=lambda value: value.lower() == 'true')
+    parser.add_argument('--created-from', type=datetime.fromisoformat)
+    parser.add_argument('--created-to', type=datetime.fromisoformat)
+    parser.add_argument('--after', help="resume after this cursor")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    return parser.parse_args(argv)
+
+
+async def export_users(args: argparse.Namespace) -> int:
+    users_collection = client.get_database()["users"]
+    where = crud.user.filter(
+        role=args.role,
+        is_active=args.is_active,
+        created_from=args.created_from,
+        created_to=args.created_to,
+    )
+    last = {}
+
+    async def users():
+        async for user in crud.user.iterate(
+                users_collection, where, after=args.after, batch_size=args.batch_size,
+        ):
+            last['user'] = user
+            yield user
+
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    count = 0
+    written = None
+    try:
+        async for chunk in export_ndjson(crud.user, users()):
+            output.write(chunk)
+            # a chunk is yielded right after its last user was consumed
+            written = last['user']
+            count += chunk.count(b'\n')
+    finally:
+        output.flush()
+        if output is not sys.stdout.buffer:
+            output.close()
+        if written is not None:
+            print(f"next cursor: {crud.user.next_cursor(written)}", file=sys.stderr)
+        await client.disconnect()
+    return count
+
+
+def main(argv=None):
+    count = asyncio.run(export_users(parse_args(argv)))
+    print(f"exported {count} users", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,296 @@
-from typing import List, Optional, Type, TypeVar, Generic
+import json
+from datetime import datetime
+from functools import lru_cache
+from typing import (
+    AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Type, TypeVar, Generic,
+)
 
 from fastapi import HTTPException
-from motor.motor_asyncio import AsyncIOMotorCollection
+from starlette import status
 from pydantic import BaseModel
-from pymongo.errors import DuplicateKeyError
+
+from app.crud.pagination import decode_cursor, encode_cursor
+from app.storage import Collection, DuplicateKeyError
+from app.utils.cache import MISSING, CacheBackend, TTLCache
+from app.utils.singleflight import SingleFlight
 
 
 BaseSchemaType = TypeVar("BaseSchemaType", bound=BaseModel)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
+precondition_failed_exception = HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail="Object was modified since it was retrieved",
+    )
+
+
+class Filter(NamedTuple):
+    """ Storage query, with the collation it must run with to use its index """
+    query: dict
+    collation: Optional[dict] = None
+
+
+@lru_cache(maxsize=None)
+def fields_for(model: Type[BaseModel]) -> Tuple[str, ...]:
+    """ Names of the stored fields making up `model` """
+    return tuple(field.alias for field in model.__fields__.values())
+
 
 class CRUDBase(Generic[BaseSchemaType, CreateSchemaType, UpdateSchemaType]):
-    def __init__(self, model: Type[BaseSchemaType]):
+    def __init__(
+            self,
+            model: Type[BaseSchemaType],
+            sort_keys: Sequence[str] = ("id",),
+            cache: Optional[CacheBackend] = None,
+            negative_ttl: float = 0,
+            count_ttl: float = 0,
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
 
         **Parameters**
 
-        * `coll`: A MongoDB collection object
+        * `coll`: A storage `Collection`
         * `model`: A Pydantic Base model (schema) class used to retrieve data
+        * `sort_keys`: Fields defining the stable listing order used for cursor
+          pagination. Must end with a unique field and be backed by an index
+        * `cache`: Optional read-through cache used by `get`, invalidated by
+          the writes made through this object
+        * `negative_ttl`: How long `get` remembers that an id doesn't exist
+        * `count_ttl`: How long `count` reuses the total of a filtered query
         """
         self.model = model
+        self.fields = fields_for(model)
+        self.sort_keys = tuple(sort_keys)
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        self.flights = SingleFlight()
+        # cache key -> [generation, reads in flight], while reads are in flight
+        self._generations: Dict[str, List[int]] = {}
+        self.counts = TTLCache(1024, count_ttl)
+        self._listeners: List[Callable[[str], None]] = []
+
+    def subscribe(self, listener: Callable[[str], None]):
+        """ Register a callback invoked with the id of every updated or removed object """
+        self._listeners.append(listener)
+
+    def _notify(self, _id: str):
+        for listener in self._listeners:
+            listener(_id)
+
+    def from_db(self, obj: dict, model: Type[BaseModel] = None) -> BaseSchemaType:
+        """
+        Build a model from a document fetched with its projection. The document
+        was validated before it was written, so it is not validated again.
+        """
+        return (model or self.model).construct(**obj)
+
+    @staticmethod
+    def _cache_key(_id: str, coll: Collection) -> str:
+        return f'{coll.full_name}:{_id}'
 
-    async def get(self, _id: str, coll: AsyncIOMotorCollection) -> Optional[BaseSchemaType]:
-        obj = await coll.find_one({"id": _id})
+    async def _invalidate(self, _id: str, coll: Collection):
+        key = self._cache_key(_id, coll)
+        # reads started before the write must neither be cached nor joined
+        state = self._generations.get(key)
+        if state is not None:
+            state[0] += 1
+        self.flights.forget(key)
+        if self.cache is not None:
+            await self.cache.delete(key)
+
+    async def get(self, _id: str, coll: Collection) -> Optional[BaseSchemaType]:
+        """
+        Fetch an object by id through the cache. Concurrent misses for the
+        same id share a single DB query.
+        """
+        key = self._cache_key(_id, coll)
+        if self.cache is None:
+            return await self.flights.do(key, lambda: self._get(_id, coll))
+        obj = await self.cache.get(key)
+        if obj is MISSING:
+            obj = await self.flights.do(key, lambda: self._get_and_cache(key, _id, coll))
+        return obj
+
+    async def _get_and_cache(
+            self, key: str, _id: str, coll: Collection,
+    ) -> Optional[BaseSchemaType]:
+        state = self._generations.get(key)
+        if state is None:
+            state = self._generations[key] = [0, 0]
+        generation = state[0]
+        state[1] += 1
+        try:
+            obj = await self._get(_id, coll)
+            if state[0] == generation:
+                await self.cache.set(key, obj, None if obj is not None else self.negative_ttl)
+                if state[0] != generation:
+                    # invalidated while the entry was being written
+                    await self.cache.delete(key)
+            return obj
+        finally:
+            state[1] -= 1
+            if not state[1] and self._generations.get(key) is state:
+                del self._generations[key]
+
+    async def _get(self, _id: str, coll: Collection) -> Optional[BaseSchemaType]:
+        obj = await coll.get(_id, self.fields)
         if obj:
-            return self.model(**obj)
+            return self.from_db(obj)
+
+    async def get_many(
+            self, ids: Sequence[str], coll: Collection,
+    ) -> List[BaseSchemaType]:
+        """ Fetch the objects with the given ids in one query; unknown ids are skipped """
+        return [self.from_db(obj) for obj in await coll.get_many(ids, self.fields)]
 
     async def get_multi(
-            self, coll: AsyncIOMotorCollection, skip: int = 0, limit: int = 12,
+            self,
+            coll: Collection,
+            skip: int = 0,
+            limit: int = 12,
+            after: Optional[str] = None,
+            where: Optional[Filter] = None,
     ) -> List[BaseSchemaType]:
-        cursor = coll.find().skip(skip).limit(limit)
-        objs = [self.model(**obj) async for obj in cursor]
+        """
+        List objects matching `where` ordered by `sort_keys`. Pass the
+        `next_cursor` of the previous page as `after` to continue from there;
+        `skip` is kept for backward compatibility only as it gets slower with
+        every page.
+        """
+        cursor = self._find(coll, where, after, skip=skip, limit=limit)
+        objs = [self.from_db(obj) async for obj in cursor]
         return objs
 
+    async def count(self, coll: Collection, where: Optional[Filter] = None) -> int:
+        """
+        Number of objects matching `where`. The whole collection is counted
+        from its metadata; filtered totals are cached for `count_ttl` seconds
+        by normalized filter, so they may lag behind recent writes.
+        """
+        if where is None or not where.query:
+            return await coll.count()
+        key = json.dumps(
+            [coll.full_name, where.query, where.collation], sort_keys=True, default=str,
+        )
+        total = self.counts.get(key)
+        if total is None:
+            total = await self.flights.do(key, lambda: coll.count(where.query, where.collation))
+            self.counts.set(key, total)
+        return total
+
+    def iterate(
+            self,
+            coll: Collection,
+            where: Optional[Filter] = None,
+            after: Optional[str] = None,
+            batch_size: int = 1000,
+    ) -> AsyncIterator[BaseSchemaType]:
+        """
+        Stream every object matching `where` in `sort_keys` order, fetching
+        `batch_size` documents per round-trip. Memory use doesn't depend on
+        the number of objects. The cursor is validated right away, before the
+        first object is awaited.
+        """
+        cursor = self._find(coll, where, after, batch_size=batch_size)
+        return (self.from_db(obj) async for obj in cursor)
+
+    def _find(self, coll: Collection, where: Optional[Filter], after: Optional[str], **options):
+        where = where or Filter({})
+        if after is not None:
+            options["after"] = decode_cursor(after, len(self.sort_keys))
+        return coll.find(where.query, self.fields, self.sort_keys, where.collation, **options)
+
+    def next_cursor(self, obj: BaseSchemaType) -> str:
+        """ Cursor pointing right after `obj`, to be passed as `after` """
+        return encode_cursor([getattr(obj, key) for key in self.sort_keys])
+
+    @staticmethod
+    def _new_document(obj_in: CreateSchemaType) -> dict:
+        """ Document of a new object, starting its `version` used by conditional requests """
+        return {**obj_in.dict(), "version": 1, "updated_at": datetime.utcnow()}
+
     async def create(
-            self, obj_in: CreateSchemaType, coll: AsyncIOMotorCollection,
+            self, obj_in: CreateSchemaType, coll: Collection,
     ) -> BaseSchemaType:
-        obj_dict = obj_in.dict()
+        obj_dict = self._new_document(obj_in)
         try:
-            await coll.insert_one(obj_dict)
+            await coll.create(obj_dict)
+            await self._invalidate(obj_dict["id"], coll)
             return self.model(**obj_dict)
         except DuplicateKeyError:
             raise HTTPException(
                 status_code=400, detail="Duplicate object already exists"
             )
 
+    async def create_many(
+            self, objs_in: Sequence[CreateSchemaType], coll: Collection,
+    ) -> Tuple[List[BaseSchemaType], Dict[int, str]]:
+        """
+        Insert all objects with a single unordered bulk insert. Returns the
+        created objects and the error of each rejected one keyed by its index.
+        """
+        obj_dicts = [self._new_document(obj_in) for obj_in in objs_in]
+        errors = {}
+        for index, error in (await coll.create_many(obj_dicts)).items():
+            if isinstance(error, DuplicateKeyError):
+                errors[index] = "Duplicate object already exists"
+            else:
+                errors[index] = str(error)
+        created = [
+            self.model(**obj_dict) for index, obj_dict in enumerate(obj_dicts)
+            if index not in errors
+        ]
+        for obj in created:
+            await self._invalidate(obj.id, coll)
+        return created, errors
+
+    def update_operations(self, update_data: dict) -> dict:
+        """ Update document applied by `update`, extend to maintain derived fields """
+        return {
+            "$set": {**update_data, "updated_at": datetime.utcnow()},
+            "$inc": {"version": 1},
+        }
+
     async def update(
-            self, _id: str, obj_in: UpdateSchemaType | dict, coll: AsyncIOMotorCollection,
+            self,
+            _id: str,
+            obj_in: UpdateSchemaType | dict,
+            coll: Collection,
+            expected_version: Optional[int] = None,
     ) -> Optional[BaseSchemaType]:
-        obj = await self.get(_id, coll)
-        if not obj:
-            return None
+        """
+        Set the given fields and return the updated object. With
+        `expected_version` the update only applies to that version of the
+        object, otherwise a 412 is raised.
+        """
         if isinstance(obj_in, BaseModel):
             update_data = obj_in.dict(exclude_unset=True)
         else:
             update_data = obj_in
-        obj_dict = obj.dict()
-        obj_dict.update(update_data)
-        obj = self.model(**obj_dict)
-        await coll.update_one({"id": _id}, {"$set": obj_dict})
-        return obj
+        if not update_data:
+            obj = await self.get(_id, coll)
+            if obj and expected_version is not None and (obj.version or 0) != expected_version:
+                raise precondition_failed_exception
+            return obj
+        query = {"id": _id}
+        if expected_version is not None:
+            # documents written before versioning have no version field
+            query["version"] = expected_version or {"$in": [0, None]}
+        obj = await coll.update(query, self.update_operations(update_data), self.fields)
+        if not obj:
+            if expected_version is not None and await self._get(_id, coll) is not None:
+                raise precondition_failed_exception
+            return None
+        await self._invalidate(_id, coll)
+        self._notify(_id)
+        return self.from_db(obj)
 
-    async def remove(self, _id: str, coll: AsyncIOMotorCollection) -> Optional[BaseModel]:
-        obj = await self.get(_id, coll)
-        if obj:
-            await coll.delete_one({"id": _id})
-        return obj
+    async def remove(self, _id: str, coll: Collection) -> Optional[BaseModel]:
+        obj = await coll.delete(_id, self.fields)
+        if not obj:
+            return None
+        await self._invalidate(_id, coll)
+        self._notify(_id)
+        return self.from_db(obj)
@@ -1,18 +1,105 @@
-from typing import Optional
+from datetime import datetime
+from typing import Dict, Optional, Sequence
 
-from motor.motor_asyncio import AsyncIOMotorCollection
+from app.config import settings
+from app.crud.base import CRUDBase, Filter, fields_for
+from app.db.user import NAME_COLLATION
+from app.storage import Collection
+from app.utils.cache import InMemoryCacheBackend
+from app.schemas import RetrieveUser, CreateUser, UpdateUser, RetrieveUserWithPass, UserRole
 
-from app.crud.base import CRUDBase
-from app.schemas import RetrieveUser, CreateUser, UpdateUser, RetrieveUserWithPass
+# Changing any of these fields revokes the stateless tokens issued so far
+TOKEN_VERSION_FIELDS = {'hashed_pass', 'role', 'is_active'}
+# What token introspection needs to know about a user
+PRINCIPAL_FIELDS = ('id', 'first_name', 'last_name', 'role', 'is_active', 'token_version')
 
 
 class UserCRUD(CRUDBase[RetrieveUser, CreateUser, UpdateUser]):
     async def get_with_hash_pass(
-            self, _id: str, coll: AsyncIOMotorCollection,
+            self, _id: str, coll: Collection,
     ) -> Optional[RetrieveUserWithPass]:
-        obj = await coll.find_one({"id": _id})
+        obj = await coll.get(_id, fields_for(RetrieveUserWithPass))
         if obj:
-            return RetrieveUserWithPass(**obj)
+            return self.from_db(obj, RetrieveUserWithPass)
 
+    async def get_principals(self, ids: Sequence[str], coll: Collection) -> Dict[str, dict]:
+        """ Identity fields of the users with the given ids by id, in one query """
+        return {obj["id"]: obj for obj in await coll.get_many(ids, PRINCIPAL_FIELDS)}
 
-user = UserCRUD(RetrieveUser)
+    async def rehash_password(self, _id: str, old_hash: str, new_hash: str, coll: Collection):
+        """
+        Replace a hash of the same password made with a lower cost. Neither
+        `version` nor `token_version` changes, and a password changed
+        meanwhile is kept.
+        """
+        await coll.update(
+            {"id": _id, "hashed_pass": old_hash}, {"$set": {"hashed_pass": new_hash}}, ("id",),
+        )
+
+    async def get_token_version(self, _id: str, coll: Collection) -> Optional[int]:
+        obj = await coll.get(_id, ("token_version",))
+        if obj is not None:
+            return obj.get("token_version", 0)
+
+    @staticmethod
+    def filter(
+            role: Optional[UserRole] = None,
+            is_active: Optional[bool] = None,
+            first_name: Optional[str] = None,
+            last_name: Optional[str] = None,
+            created_from: Optional[datetime] = None,
+            created_to: Optional[datetime] = None,
+    ) -> Filter:
+        """
+        Compile user filters into a storage query; `None` means "any". Names
+        are case-insensitive prefixes, matched as a range under
+        `NAME_COLLATION` so that they use the name indexes.
+        """
+        query = {}
+        if role is not None:
+            query["role"] = role
+        if is_active is not None:
+            query["is_active"] = is_active
+        if created_from is not None:
+            query.setdefault("created_at", {})["$gte"] = created_from
+        if created_to is not None:
+            query.setdefault("created_at", {})["$lt"] = created_to
+        for field, prefix in (("last_name", last_name), ("first_name", first_name)):
+            if prefix:
+                # U+FFFF sorts after every character under ICU collations
+                query[field] = {"$gte": prefix, "$lt": f"{prefix}\uffff"}
+        if last_name or first_name:
+            return Filter(query, NAME_COLLATION)
+        return Filter(query)
+
+    async def update_last_logins(self, logins: Dict[str, datetime], coll: Collection):
+        """
+        Move `last_login` of many users forward in one unordered bulk write.
+        A timestamp older than the stored one changes nothing. `updated_at`
+        moves with it, as Last-Modified must change along with the ETag.
+        """
+        await coll.update_many([
+            (
+                {"id": _id, "$or": [{"last_login": {"$lt": when}}, {"last_login": None}]},
+                {"$max": {"last_login": when, "updated_at": when}, "$inc": {"version": 1}},
+            )
+            for _id, when in logins.items()
+        ])
+        for _id in logins:
+            await self._invalidate(_id, coll)
+
+    def update_operations(self, update_data: dict) -> dict:
+        operations = super().update_operations(update_data)
+        if TOKEN_VERSION_FIELDS & update_data.keys():
+            operations["$inc"]["token_version"] = 1
+        return operations
+
+
+user = UserCRUD(
+    RetrieveUser,
+    sort_keys=("created_at", "id"),
+    cache=InMemoryCacheBackend(settings.user_cache_size, settings.user_cache_ttl)
+    if settings.user_cache_size else None,
+    negative_ttl=settings.user_cache_negative_ttl,
+    count_ttl=settings.count_cache_ttl,
+)
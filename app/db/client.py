@@ -0,0 +1,152 @@
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from app.config import settings
+from app.db.user import metadata
+from app.storage import StorageEngine
+from app.storage.memory import MemoryEngine
+from app.storage.motor import MotorEngine
+from app.storage.sql import SQLEngine
+from app.utils.metrics import db_command_duration
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """ Connection pool listener keeping counters for the shared client """
+
+    def __init__(self):
+        self.pools = 0
+        self.open_connections = 0
+        self.checked_out = 0
+        self.check_out_failures = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.pools_cleared = 0
+
+    def pool_created(self, event):
+        self.pools += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.pools_cleared += 1
+
+    def pool_closed(self, event):
+        self.pools -= 1
+
+    def connection_created(self, event):
+        self.connections_created += 1
+        self.open_connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.connections_closed += 1
+        self.open_connections -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.check_out_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_pool_size": settings.mongo_max_pool_size,
+            "min_pool_size": settings.mongo_min_pool_size,
+            "pools": self.pools,
+            "open_connections": self.open_connections,
+            "checked_out": self.checked_out,
+            "idle": self.open_connections - self.checked_out,
+            "check_out_failures": self.check_out_failures,
+            "connections_created": self.connections_created,
+            "connections_closed": self.connections_closed,
+            "pools_cleared": self.pools_cleared,
+        }
+
+
+class CommandTimingListener(monitoring.CommandListener):
+    """ Records the driver-measured duration of every command in `db_command_duration` """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        db_command_duration.observe(event.duration_micros / 1_000_000, event.command_name, 'success')
+
+    def failed(self, event):
+        db_command_duration.observe(event.duration_micros / 1_000_000, event.command_name, 'failure')
+
+
+pool_listener = PoolStatsListener()
+command_listener = CommandTimingListener()
+_client: Optional[AsyncIOMotorClient] = None
+_database: Optional[StorageEngine] = None
+
+
+def connect() -> AsyncIOMotorClient:
+    """ Create the application-wide client. Safe to call more than once. """
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            settings.mongo_uri,
+            maxPoolSize=settings.mongo_max_pool_size,
+            minPoolSize=settings.mongo_min_pool_size,
+            maxIdleTimeMS=settings.mongo_max_idle_time_ms,
+            waitQueueTimeoutMS=settings.mongo_wait_queue_timeout_ms,
+            connectTimeoutMS=settings.mongo_connect_timeout_ms,
+            socketTimeoutMS=settings.mongo_socket_timeout_ms,
+            serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+            event_listeners=[pool_listener, command_listener],
+        )
+    return _client
+
+
+def close():
+    global _client, _database
+    _database = None
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+async def disconnect():
+    """ Release the connections of the storage engine, then `close` """
+    if _database is not None:
+        await _database.disconnect()
+    close()
+
+
+def get_database() -> StorageEngine:
+    """
+    Database of the configured `storage_engine`. It is created on first use
+    when the application lifespan has not run (e.g. in tests without a lifespan).
+    """
+    global _database
+    if _database is None:
+        if settings.storage_engine == 'memory':
+            _database = MemoryEngine(settings.db_name)
+        elif settings.storage_engine == 'sql':
+            _database = SQLEngine(settings.sql_url, metadata, **sql_pool_options(settings.sql_url))
+        else:
+            _database = MotorEngine(connect()[settings.db_name])
+    return _database
+
+
+def sql_pool_options(url: str) -> dict:
+    if url.startswith('sqlite'):
+        return {}
+    return {"min_size": settings.sql_min_pool_size, "max_size": settings.sql_max_pool_size}
+
+
+def pool_stats() -> dict:
+    return pool_listener.stats()
@@ -1,7 +1,41 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+import sqlalchemy
 
+from app.storage import StorageEngine
 
-async def create_user_index(db: AsyncIOMotorClient):
+# Case-insensitive comparison used by the name indexes and prefix searches
+NAME_COLLATION = {"locale": "en", "strength": 2}
+
+metadata = sqlalchemy.MetaData()
+
+# Table of the SQL storage engine, one column per stored user field
+users_table = sqlalchemy.Table(
+    "users",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.String(64), primary_key=True),
+    sqlalchemy.Column("first_name", sqlalchemy.String(24), nullable=False),
+    sqlalchemy.Column("last_name", sqlalchemy.String(24), nullable=False),
+    sqlalchemy.Column("role", sqlalchemy.String(16), nullable=False),
+    sqlalchemy.Column("is_active", sqlalchemy.Boolean, nullable=False),
+    sqlalchemy.Column("hashed_pass", sqlalchemy.String(128), nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    sqlalchemy.Column("last_login", sqlalchemy.DateTime),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime),
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("token_version", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+
+
+async def create_user_index(db: StorageEngine):
 
     users_collection = db['users']
     await users_collection.create_index('id', unique=True)
+    # listing order of crud.user, used for cursor pagination
+    await users_collection.create_index([('created_at', 1), ('id', 1)])
+    # filters of GET /users/, each followed by the listing order
+    await users_collection.create_index([('role', 1), ('is_active', 1), ('created_at', 1), ('id', 1)])
+    await users_collection.create_index([('role', 1), ('created_at', 1), ('id', 1)])
+    await users_collection.create_index([('is_active', 1), ('created_at', 1), ('id', 1)])
+    await users_collection.create_index(
+        [('last_name', 1), ('first_name', 1)], collation=NAME_COLLATION,
+    )
+    await users_collection.create_index([('first_name', 1)], collation=NAME_COLLATION)
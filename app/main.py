@@ -1,21 +1,58 @@
 import uvicorn
 from fastapi import FastAPI
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.responses import PlainTextResponse
 
+from app import crud
+from app.db import client
 from app.db.user import create_user_index
 from app.api.routers import users
 
 from app.config import settings
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 
-from app.utils.middlewares import JWTAuthenticationMiddleware
+from app.utils.hashing import password_hasher
+from app.utils.write_behind import last_login_buffer
+from app.utils.metrics import Gauge, MetricsMiddleware, registry
+from app.utils.profiling import ProfilingMiddleware
+from app.utils.throttling import login_throttle
+from app.utils.middlewares import (
+    JWTAuthenticationMiddleware, principal_cache, principal_flights,
+)
 
 app = FastAPI()
 
 # app.add_middleware(
 #     TrustedHostMiddleware, allowed_hosts=settings.allowed_hosts
 # )
+if settings.profiling_enabled:
+    # inside the authentication middleware, to check the admin scope
+    app.add_middleware(
+        ProfilingMiddleware,
+        directory=settings.profiling_dir,
+        interval=settings.profiling_sample_interval,
+    )
 app.add_middleware(JWTAuthenticationMiddleware)
+# outermost, so the latency includes authentication
+app.add_middleware(MetricsMiddleware)
+
+registry.register(Gauge(
+    'mongo_pool_connections',
+    'Connections of the MongoDB pool by state.',
+    lambda: {
+        (state,): client.pool_stats()[state] for state in ('open_connections', 'checked_out', 'idle')
+    },
+    ('state',),
+))
+registry.register(Gauge(
+    'password_hasher_in_flight',
+    'Password operations running or queued.',
+    lambda: {(): password_hasher.in_flight},
+))
+registry.register(Gauge(
+    'last_login_pending',
+    'Logins waiting for the next last_login flush.',
+    lambda: {(): last_login_buffer.stats()["pending"]},
+))
 
 
 @app.get('/alive', status_code=200)
@@ -23,13 +60,42 @@ async def health_check():
     return {"Hello": "World"}
 
 
+@app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/stats', status_code=200)
+async def service_stats():
+    return {
+        "mongo_pool": client.pool_stats(),
+        "password_hasher": password_hasher.stats(),
+        "login_throttle": login_throttle.stats(),
+        "principal_cache": principal_cache.stats(),
+        "user_cache": crud.user.cache.stats() if crud.user.cache else None,
+        "last_login_buffer": last_login_buffer.stats(),
+        "single_flight": {
+            "user_get": crud.user.flights.stats(),
+            "principal": principal_flights.stats(),
+        },
+    }
+
+
 @app.on_event("startup")
 async def startup():
-    client = AsyncIOMotorClient(settings.mongo_uri)
-    database = client[settings.mongo_initdb_database]
+    await create_user_index(client.get_database())
+    if settings.password_hash_target_ms:
+        await password_hasher.calibrate(
+            settings.password_hash_target_ms / 1000, settings.password_hash_min_rounds,
+        )
+    last_login_buffer.start()
+
 
-    await create_user_index(database)
-    client.close()
+@app.on_event("shutdown")
+async def shutdown():
+    await last_login_buffer.stop()
+    password_hasher.shutdown()
+    await client.disconnect()
 
 
 app.include_router(users.router)
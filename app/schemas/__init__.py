@@ -1,7 +1,13 @@
 from .user import (
     BaseUpdateUser,
+    BatchGetUsers,
+    BulkCreateUsersRequest,
+    BulkCreateUsersResponse,
+    BulkItemError,
     CreateUser,
     CreateUserRequest,
+    IntrospectTokens,
+    IntrospectTokensResponse,
     RetrieveUser,
     RetrieveUserWithPass,
     RefreshTokenSchema,
@@ -9,5 +15,7 @@ from .user import (
     UpdateUser,
     TokenSchema,
     TokenPayload,
+    TokenIntrospection,
     LoginUser,
+    UserRole,
 )
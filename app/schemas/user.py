@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, validator, Field
 
@@ -27,6 +27,8 @@ class RetrieveUser(BaseUser):
     is_active: bool
     created_at: Optional[datetime] = None
     last_login: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    version: int = 0
 
     class Config:
         orm_mode = True
@@ -34,6 +36,7 @@ class RetrieveUser(BaseUser):
 
 class RetrieveUserWithPass(RetrieveUser):
     hashed_pass: str
+    token_version: int = 0
 
 
 class CreateUserRequest(BaseUser):
@@ -53,9 +56,28 @@ class CreateUserRequest(BaseUser):
 class CreateUser(BaseUser):
     id: str
     is_active: bool = True
-    created_at: Optional[datetime] = datetime.now()
-    last_login: Optional[datetime] = datetime.now()
+    created_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
+    last_login: Optional[datetime] = Field(default_factory=datetime.utcnow)
     hashed_pass: str
+    token_version: int = 0
+
+
+class BatchGetUsers(BaseModel):
+    ids: List[str] = Field(..., min_items=1, max_items=5000, description="user IDs")
+
+
+class BulkCreateUsersRequest(BaseModel):
+    users: List[CreateUserRequest] = Field(..., min_items=1, max_items=1000)
+
+
+class BulkItemError(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkCreateUsersResponse(BaseModel):
+    created: List[RetrieveUser]
+    errors: List[BulkItemError]
 
 
 class LoginUser(BaseModel):
@@ -72,6 +94,27 @@ class TokenSchema(BaseModel):
 class TokenPayload(BaseModel):
     sub: str = None
     exp: int = None
+    role: Optional[UserRole] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    ver: Optional[int] = None
+
+
+class IntrospectTokens(BaseModel):
+    tokens: List[str] = Field(..., min_items=1, max_items=1000, description="access tokens")
+
+
+class TokenIntrospection(BaseModel):
+    active: bool
+    sub: Optional[str] = None
+    exp: Optional[int] = None
+    role: Optional[UserRole] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+
+
+class IntrospectTokensResponse(BaseModel):
+    tokens: List[TokenIntrospection]
 
 
 class RefreshTokenSchema(BaseModel):
@@ -0,0 +1 @@
+from .base import Collection, DuplicateKeyError, StorageEngine, StorageError
@@ -0,0 +1,129 @@
+from abc import ABC, abstractmethod
+from typing import (
+    Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union,
+)
+
+# Index keys as accepted by `create_index`: a field name, or (field, direction) pairs
+IndexKeys = Union[str, Sequence[Tuple[str, int]]]
+
+
+def keyset_query(sort_keys: Sequence[str], values: Sequence[Any]) -> dict:
+    """
+    Mongo query matching the objects placed strictly after `values` in the
+    ascending order of `sort_keys`. Nulls sort first, so "after null" means
+    "any non-null value".
+    """
+    clauses = []
+    for i, key in enumerate(sort_keys):
+        clause = dict(zip(sort_keys[:i], values[:i]))
+        clause[key] = {"$ne": None} if values[i] is None else {"$gt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+class StorageError(Exception):
+    """ A storage engine could not complete an operation """
+
+
+class DuplicateKeyError(StorageError):
+    """ A document with the same unique key already exists """
+
+
+class Collection(ABC):
+    """
+    Documents of one kind, identified by their unique `id` field. Queries and
+    updates use the subset of the Mongo language the CRUD layer emits:
+
+    * queries: field equality, `$in`, `$ne`, `$gt` / `$gte` / `$lt` / `$lte`,
+      `$or` and `$and`; `None` matches a missing field
+    * updates: `$set`, `$inc` and `$max`
+
+    `fields` lists the fields returned for each document.
+    """
+    full_name: str
+
+    @abstractmethod
+    async def get(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def get_many(self, ids: Sequence[str], fields: Sequence[str]) -> List[dict]:
+        """ Documents with the given ids, in no particular order; unknown ids are skipped """
+
+    @abstractmethod
+    def find(
+            self,
+            query: dict,
+            fields: Sequence[str],
+            sort: Sequence[str],
+            collation: Optional[dict] = None,
+            skip: int = 0,
+            limit: int = 0,
+            batch_size: int = 0,
+            after: Optional[Sequence[Any]] = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Documents matching `query` in ascending `sort` order, nulls first.
+        With `after`, the values of `sort` in the last document of the
+        previous page, only the documents placed after it are returned.
+        `limit` 0 means no limit; `batch_size` is how many documents are
+        fetched at a time.
+        """
+
+    @staticmethod
+    def after_query(query: dict, sort: Sequence[str], after: Optional[Sequence[Any]]) -> dict:
+        """ `query` restricted to the documents after `after` with `keyset_query` """
+        if after is None:
+            return query
+        if not query:
+            return keyset_query(sort, after)
+        return {"$and": [query, keyset_query(sort, after)]}
+
+    @abstractmethod
+    async def count(self, query: Optional[dict] = None, collation: Optional[dict] = None) -> int:
+        """ Number of documents matching `query`; may be an estimate without a query """
+
+    @abstractmethod
+    async def create(self, doc: dict):
+        """ Insert a document, raises `DuplicateKeyError` """
+
+    @abstractmethod
+    async def create_many(self, docs: Sequence[dict]) -> Dict[int, StorageError]:
+        """ Insert the documents unordered; returns the error of each rejected one by index """
+
+    @abstractmethod
+    async def update(self, query: dict, update: dict, fields: Sequence[str]) -> Optional[dict]:
+        """ Update the first document matching `query`; returns it as updated, or `None` """
+
+    @abstractmethod
+    async def update_many(self, operations: Sequence[Tuple[dict, dict]]):
+        """ Apply each (query, update) pair to the first document it matches, unordered """
+
+    @abstractmethod
+    async def delete(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        """ Delete a document; returns it, or `None` """
+
+    @abstractmethod
+    async def create_index(self, keys: IndexKeys, unique: bool = False, collation: Optional[dict] = None):
+        pass
+
+
+class StorageEngine(ABC):
+    """ A database: collections by name """
+
+    @abstractmethod
+    def __getitem__(self, name: str) -> Collection:
+        pass
+
+    @abstractmethod
+    async def drop(self):
+        """ Delete every collection """
+
+    async def disconnect(self):
+        """ Release the connections of the engine """
+
+
+def index_fields(keys: IndexKeys) -> List[str]:
+    if isinstance(keys, str):
+        return [keys]
+    return [field for field, _ in keys]
@@ -0,0 +1,262 @@
+"""
+Storage engine keeping documents in process memory, for local runs, tests
+and benchmarks without a database server. Documents are stored by `id`;
+`create_index` adds a hash index on the first field of the index, used by
+queries with an equality or `$in` condition on that field. Every operation
+completes without yielding to the event loop, so concurrent tasks always see
+whole writes.
+"""
+import heapq
+from collections import defaultdict
+from enum import Enum
+from operator import itemgetter
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from app.storage.base import (
+    Collection, DuplicateKeyError, IndexKeys, StorageEngine, StorageError, index_fields,
+)
+
+
+def _normalize(value: Any, collation: Optional[dict]) -> Any:
+    if collation is not None and collation.get("strength", 3) < 3 and isinstance(value, str):
+        return value.casefold()
+    return value
+
+
+def _compare(op: str, value: Any, expected: Any, collation: Optional[dict]) -> bool:
+    if op == "$eq":
+        return _normalize(value, collation) == _normalize(expected, collation)
+    if op == "$ne":
+        return _normalize(value, collation) != _normalize(expected, collation)
+    if op == "$in":
+        return any(_compare("$eq", value, item, collation) for item in expected)
+    # range operators never match across null and other types
+    if value is None or expected is None:
+        return False
+    value, expected = _normalize(value, collation), _normalize(expected, collation)
+    if op == "$gt":
+        return value > expected
+    if op == "$gte":
+        return value >= expected
+    if op == "$lt":
+        return value < expected
+    if op == "$lte":
+        return value <= expected
+    raise NotImplementedError(f"Unsupported query operator {op}")
+
+
+def _is_operator(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and next(iter(condition)).startswith("$")
+
+
+def matches(doc: dict, query: dict, collation: Optional[dict] = None) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, clause, collation) for clause in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, clause, collation) for clause in condition):
+                return False
+        elif _is_operator(condition):
+            value = doc.get(key)
+            if not all(_compare(op, value, expected, collation) for op, expected in condition.items()):
+                return False
+        elif not _compare("$eq", doc.get(key), condition, collation):
+            return False
+    return True
+
+
+def apply_update(doc: dict, update: dict):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == "$set":
+                doc[key] = value
+            elif op == "$inc":
+                doc[key] = (doc.get(key) or 0) + value
+            elif op == "$max":
+                current = doc.get(key)
+                if current is None or value > current:
+                    doc[key] = value
+            else:
+                raise NotImplementedError(f"Unsupported update operator {op}")
+
+
+def project(doc: dict, fields: Sequence[str]) -> dict:
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def _index_key(value: Any) -> Any:
+    # str enums hash by name, not by the value they compare equal to
+    return value.value if isinstance(value, Enum) else value
+
+
+def _sort_key(value: Any) -> tuple:
+    return (False, 0) if value is None else (True, value)
+
+
+class MemoryCollection(Collection):
+    def __init__(self, database: str, name: str):
+        self.name = name
+        self.full_name = f"{database}.{name}"
+        self._docs: Dict[str, dict] = {}
+        # field -> value -> ids
+        self._indexes: Dict[str, Dict[Any, Set[str]]] = {}
+
+    def _index(self, doc: dict):
+        for field, index in self._indexes.items():
+            index[_index_key(doc.get(field))].add(doc["id"])
+
+    def _unindex(self, doc: dict):
+        for field, index in self._indexes.items():
+            key = _index_key(doc.get(field))
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(doc["id"])
+                if not ids:
+                    del index[key]
+
+    def _candidates(self, query: dict) -> Iterable[dict]:
+        """ Documents that may match `query`, narrowed by the most selective index """
+        best: Optional[Set[str]] = None
+        for field, condition in query.items():
+            if field == "id":
+                index = None
+            elif field in self._indexes:
+                index = self._indexes[field]
+            else:
+                continue
+            if not _is_operator(condition):
+                values = [condition]
+            elif condition.keys() == {"$in"}:
+                values = condition["$in"]
+            else:
+                continue
+            if index is None:
+                ids = {value for value in values if value in self._docs}
+            else:
+                ids = set().union(*(index.get(_index_key(value), ()) for value in values))
+            if best is None or len(ids) < len(best):
+                best = ids
+        if best is None:
+            return self._docs.values()
+        return [self._docs[_id] for _id in best]
+
+    def _find(self, query: dict, collation: Optional[dict] = None) -> List[dict]:
+        return [doc for doc in self._candidates(query) if matches(doc, query, collation)]
+
+    async def get(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        doc = self._docs.get(_id)
+        if doc is not None:
+            return project(doc, fields)
+
+    async def get_many(self, ids: Sequence[str], fields: Sequence[str]) -> List[dict]:
+        return [project(self._docs[_id], fields) for _id in dict.fromkeys(ids) if _id in self._docs]
+
+    def find(
+            self,
+            query: dict,
+            fields: Sequence[str],
+            sort: Sequence[str],
+            collation: Optional[dict] = None,
+            skip: int = 0,
+            limit: int = 0,
+            batch_size: int = 0,
+            after: Optional[Sequence[Any]] = None,
+    ) -> AsyncIterator[dict]:
+        docs = self._find(self.after_query(query, sort, after), collation)
+        key = itemgetter(*sort) if sort else None
+
+        def sort_key(doc: dict) -> tuple:
+            # nulls sort first, as in Mongo
+            return tuple(_sort_key(doc.get(field)) for field in sort)
+
+        try:
+            # plain values compare directly, much faster than wrapping them
+            docs = self._ordered(docs, key, skip, limit)
+        except (KeyError, TypeError):
+            docs = self._ordered(docs, sort_key, skip, limit)
+        # the page is copied right away, later writes don't affect it
+        return self._iterate([project(doc, fields) for doc in docs])
+
+    @staticmethod
+    def _ordered(docs: List[dict], key, skip: int, limit: int) -> List[dict]:
+        if limit:
+            return heapq.nsmallest(skip + limit, docs, key=key)[skip:]
+        return sorted(docs, key=key)[skip:]
+
+    @staticmethod
+    async def _iterate(docs: List[dict]) -> AsyncIterator[dict]:
+        for doc in docs:
+            yield doc
+
+    async def count(self, query: Optional[dict] = None, collation: Optional[dict] = None) -> int:
+        if not query:
+            return len(self._docs)
+        return len(self._find(query, collation))
+
+    def _insert(self, doc: dict):
+        if doc["id"] in self._docs:
+            raise DuplicateKeyError(f"Duplicate key id: {doc['id']}")
+        doc = dict(doc)
+        self._docs[doc["id"]] = doc
+        self._index(doc)
+
+    async def create(self, doc: dict):
+        self._insert(doc)
+
+    async def create_many(self, docs: Sequence[dict]) -> Dict[int, StorageError]:
+        errors = {}
+        for index, doc in enumerate(docs):
+            try:
+                self._insert(doc)
+            except DuplicateKeyError as exc:
+                errors[index] = exc
+        return errors
+
+    def _update(self, query: dict, update: dict) -> Optional[dict]:
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                self._unindex(doc)
+                apply_update(doc, update)
+                self._index(doc)
+                return doc
+        return None
+
+    async def update(self, query: dict, update: dict, fields: Sequence[str]) -> Optional[dict]:
+        doc = self._update(query, update)
+        if doc is not None:
+            return project(doc, fields)
+
+    async def update_many(self, operations: Sequence[Tuple[dict, dict]]):
+        for query, update in operations:
+            self._update(query, update)
+
+    async def delete(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        doc = self._docs.pop(_id, None)
+        if doc is not None:
+            self._unindex(doc)
+            return project(doc, fields)
+
+    async def create_index(self, keys: IndexKeys, unique: bool = False, collation: Optional[dict] = None):
+        field = index_fields(keys)[0]
+        # `id` is the primary key; collated indexes serve ranges, not equality
+        if field == "id" or collation is not None or field in self._indexes:
+            return
+        index: Dict[Any, Set[str]] = defaultdict(set)
+        for doc in self._docs.values():
+            index[_index_key(doc.get(field))].add(doc["id"])
+        self._indexes[field] = index
+
+
+class MemoryEngine(StorageEngine):
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self.name, name)
+        return self._collections[name]
+
+    async def drop(self):
+        self._collections.clear()
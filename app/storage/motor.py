@@ -0,0 +1,112 @@
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo import errors
+
+from app.storage.base import Collection, DuplicateKeyError, IndexKeys, StorageEngine, StorageError
+
+
+@lru_cache(maxsize=None)
+def projection_for(fields: Tuple[str, ...]) -> dict:
+    """ Mongo projection returning exactly `fields` """
+    return {"_id": 0, **{field: 1 for field in fields}}
+
+
+class MotorCollection(Collection):
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+        self.full_name = collection.full_name
+
+    async def get(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        return await self.collection.find_one({"id": _id}, projection_for(tuple(fields)))
+
+    async def get_many(self, ids: Sequence[str], fields: Sequence[str]) -> List[dict]:
+        cursor = self.collection.find({"id": {"$in": list(ids)}}, projection_for(tuple(fields)))
+        return [doc async for doc in cursor]
+
+    def find(
+            self,
+            query: dict,
+            fields: Sequence[str],
+            sort: Sequence[str],
+            collation: Optional[dict] = None,
+            skip: int = 0,
+            limit: int = 0,
+            batch_size: int = 0,
+            after: Optional[Sequence[Any]] = None,
+    ) -> AsyncIterator[dict]:
+        options = {} if collation is None else {"collation": collation}
+        query = self.after_query(query, sort, after)
+        cursor = self.collection.find(query, projection_for(tuple(fields)), **options)
+        cursor = cursor.sort([(field, 1) for field in sort])
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    async def count(self, query: Optional[dict] = None, collation: Optional[dict] = None) -> int:
+        if not query:
+            return await self.collection.estimated_document_count()
+        options = {} if collation is None else {"collation": collation}
+        return await self.collection.count_documents(query, **options)
+
+    async def create(self, doc: dict):
+        try:
+            # insert_one adds `_id` to the document it is given
+            await self.collection.insert_one(dict(doc))
+        except errors.DuplicateKeyError as exc:
+            raise DuplicateKeyError(str(exc)) from exc
+
+    async def create_many(self, docs: Sequence[dict]) -> Dict[int, StorageError]:
+        failed = {}
+        try:
+            await self.collection.insert_many([dict(doc) for doc in docs], ordered=False)
+        except errors.BulkWriteError as exc:
+            for error in exc.details["writeErrors"]:
+                if error["code"] == 11000:
+                    failed[error["index"]] = DuplicateKeyError(error["errmsg"])
+                else:
+                    failed[error["index"]] = StorageError(error["errmsg"])
+        return failed
+
+    async def update(self, query: dict, update: dict, fields: Sequence[str]) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            query,
+            update,
+            projection=projection_for(tuple(fields)),
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def update_many(self, operations: Sequence[Tuple[dict, dict]]):
+        await self.collection.bulk_write(
+            [UpdateOne(query, update) for query, update in operations], ordered=False,
+        )
+
+    async def delete(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        return await self.collection.find_one_and_delete(
+            {"id": _id}, projection=projection_for(tuple(fields)),
+        )
+
+    async def create_index(self, keys: IndexKeys, unique: bool = False, collation: Optional[dict] = None):
+        options = {} if collation is None else {"collation": collation}
+        await self.collection.create_index(keys, unique=unique, **options)
+
+
+class MotorEngine(StorageEngine):
+    def __init__(self, database: AsyncIOMotorDatabase):
+        self.database = database
+        self._collections: Dict[str, MotorCollection] = {}
+
+    def __getitem__(self, name: str) -> MotorCollection:
+        if name not in self._collections:
+            self._collections[name] = MotorCollection(self.database[name])
+        return self._collections[name]
+
+    async def drop(self):
+        await self.database.client.drop_database(self.database.name)
+        self._collections.clear()
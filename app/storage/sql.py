@@ -0,0 +1,386 @@
+"""
+Storage engine on a relational database through `databases`: PostgreSQL
+(asyncpg, with its connection pool and prepared statement cache) or SQLite
+for local runs. Each collection is a table of `metadata`; queries and updates
+are compiled to SQLAlchemy Core expressions. Collated comparisons, used for
+case-insensitive name prefixes, compare `lower()` of the column, which the
+matching `create_index` indexes. Driver and connection errors are raised as
+`StorageError`.
+"""
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+import sqlalchemy
+from asyncpg.exceptions import UniqueViolationError
+from databases import Database
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app.storage.base import (
+    Collection, DuplicateKeyError, IndexKeys, StorageEngine, StorageError, index_fields, keyset_query,
+)
+
+# Rows per multi-row INSERT, below the bind parameter limit of SQLite
+INSERT_BATCH_SIZE = 500
+
+
+def _is_duplicate(exc: Exception) -> bool:
+    if isinstance(exc, UniqueViolationError):
+        return True
+    return isinstance(exc, sqlite3.IntegrityError) and "UNIQUE" in str(exc)
+
+
+# Driver and connection failures, raised as `StorageError`
+DRIVER_ERRORS = (
+    sqlite3.Error, asyncpg.PostgresError, asyncpg.InterfaceError, sqlalchemy.exc.SQLAlchemyError, OSError,
+)
+
+
+@contextmanager
+def storage_errors():
+    """ Raise driver errors as `StorageError`, and unique violations as `DuplicateKeyError` """
+    try:
+        yield
+    except DRIVER_ERRORS as exc:
+        if _is_duplicate(exc):
+            raise DuplicateKeyError(str(exc)) from exc
+        raise StorageError(str(exc)) from exc
+
+
+def _value(value: Any) -> Any:
+    return value.value if isinstance(value, Enum) else value
+
+
+def _case_insensitive(collation: Optional[dict]) -> bool:
+    return collation is not None and collation.get("strength", 3) < 3
+
+
+class SQLCollection(Collection):
+    def __init__(self, engine: "SQLEngine", table: sqlalchemy.Table):
+        self.engine = engine
+        self.table = table
+        self.full_name = f"{engine.name}.{table.name}"
+
+    def _compare(self, field: str, op: str, expected: Any, collation: Optional[dict]):
+        column = self.table.c[field]
+        lower = _case_insensitive(collation) and isinstance(column.type, sqlalchemy.String)
+        if lower:
+            column = sqlalchemy.func.lower(column)
+
+        def operand(value: Any) -> Any:
+            value = _value(value)
+            return value.lower() if lower and isinstance(value, str) else value
+
+        if op == "$eq":
+            if expected is None:
+                return column.is_(None)
+            return column == operand(expected)
+        if op == "$ne":
+            if expected is None:
+                return column.isnot(None)
+            return sqlalchemy.or_(column != operand(expected), column.is_(None))
+        if op == "$in":
+            values = [operand(value) for value in expected if value is not None]
+            clause = column.in_(values)
+            if len(values) < len(expected):
+                return sqlalchemy.or_(clause, column.is_(None))
+            return clause
+        # range operators never match null, as in Mongo
+        if expected is None:
+            return sqlalchemy.false()
+        if op == "$gt":
+            return column > operand(expected)
+        if op == "$gte":
+            return column >= operand(expected)
+        if op == "$lt":
+            return column < operand(expected)
+        if op == "$lte":
+            return column <= operand(expected)
+        raise NotImplementedError(f"Unsupported query operator {op}")
+
+    def where(self, query: dict, collation: Optional[dict] = None):
+        """ SQL condition equivalent to the Mongo-style `query` """
+        clauses = []
+        for key, condition in query.items():
+            if key == "$or":
+                clauses.append(sqlalchemy.or_(*(self.where(clause, collation) for clause in condition)))
+            elif key == "$and":
+                clauses.append(sqlalchemy.and_(*(self.where(clause, collation) for clause in condition)))
+            elif isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+                clauses.extend(
+                    self._compare(key, op, expected, collation) for op, expected in condition.items()
+                )
+            else:
+                clauses.append(self._compare(key, "$eq", condition, collation))
+        return sqlalchemy.and_(sqlalchemy.true(), *clauses)
+
+    def _values(self, update: dict) -> dict:
+        values = {}
+        for op, fields in update.items():
+            for field, value in fields.items():
+                column = self.table.c[field]
+                value = _value(value)
+                if op == "$set":
+                    values[field] = value
+                elif op == "$inc":
+                    values[field] = sqlalchemy.func.coalesce(column, 0) + value
+                elif op == "$max":
+                    values[field] = sqlalchemy.case(
+                        (column.is_(None), value), (column < value, value), else_=column,
+                    )
+                else:
+                    raise NotImplementedError(f"Unsupported update operator {op}")
+        return values
+
+    def _ascending(self, column):
+        """ Ascending order with nulls first, as in Mongo, matched by the indexes """
+        if self.engine.dialect.name == "sqlite":
+            # SQLite sorts nulls first already and doesn't take NULLS FIRST in indexes
+            return column.asc()
+        return column.asc().nullsfirst()
+
+    def _select(self, fields: Sequence[str]):
+        return sqlalchemy.select(*(self.table.c[field] for field in fields if field in self.table.c))
+
+    def _row(self, record) -> dict:
+        return dict(record._mapping)
+
+    def _document(self, doc: dict) -> dict:
+        return {key: _value(value) for key, value in doc.items() if key in self.table.c}
+
+    async def get(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        with storage_errors():
+            database = await self.engine.connect()
+            record = await database.fetch_one(self._select(fields).where(self.table.c.id == _id))
+        if record is not None:
+            return self._row(record)
+
+    async def get_many(self, ids: Sequence[str], fields: Sequence[str]) -> List[dict]:
+        with storage_errors():
+            database = await self.engine.connect()
+            records = await database.fetch_all(
+                self._select(fields).where(self.table.c.id.in_(list(ids))),
+            )
+        return [self._row(record) for record in records]
+
+    def find(
+            self,
+            query: dict,
+            fields: Sequence[str],
+            sort: Sequence[str],
+            collation: Optional[dict] = None,
+            skip: int = 0,
+            limit: int = 0,
+            batch_size: int = 0,
+            after: Optional[Sequence[Any]] = None,
+    ) -> AsyncIterator[dict]:
+        statement = self._find_statement(query, fields, sort, collation, after)
+        if skip:
+            statement = statement.offset(skip)
+        if limit:
+            statement = statement.limit(limit)
+        return self._fetch(statement, stream=bool(batch_size))
+
+    def _find_statement(
+            self,
+            query: dict,
+            fields: Sequence[str],
+            sort: Sequence[str],
+            collation: Optional[dict],
+            after: Optional[Sequence[Any]],
+    ):
+        statement = self._select(fields).where(self.where(query, collation))
+        if after is not None and None not in after:
+            # a row value comparison is an index range, unlike the equivalent OR chain;
+            # rows with a null sort key sort first, so they are never after `after`
+            columns = [self.table.c[field] for field in sort]
+            statement = statement.where(sqlalchemy.tuple_(*columns) > tuple(map(_value, after)))
+        elif after is not None:
+            statement = statement.where(self.where(keyset_query(sort, after), collation))
+        return statement.order_by(*(self._ascending(self.table.c[field]) for field in sort))
+
+    async def _fetch(self, statement, stream: bool) -> AsyncIterator[dict]:
+        with storage_errors():
+            database = await self.engine.connect()
+            if stream:
+                async for record in database.iterate(statement):
+                    yield self._row(record)
+            else:
+                for record in await database.fetch_all(statement):
+                    yield self._row(record)
+
+    async def count(self, query: Optional[dict] = None, collation: Optional[dict] = None) -> int:
+        statement = sqlalchemy.select(sqlalchemy.func.count()).select_from(self.table)
+        if query:
+            statement = statement.where(self.where(query, collation))
+        with storage_errors():
+            database = await self.engine.connect()
+            return await database.fetch_val(statement)
+
+    async def create(self, doc: dict):
+        with storage_errors():
+            database = await self.engine.connect()
+            await database.execute(self.table.insert().values(self._document(doc)))
+
+    async def create_many(self, docs: Sequence[dict]) -> Dict[int, StorageError]:
+        """
+        Insert in multi-row statements of `INSERT_BATCH_SIZE`. Ids that exist
+        already, or repeat within `docs`, are rejected up front; a batch
+        failing on a concurrent insert is retried row by row.
+        """
+        failed: Dict[int, StorageError] = {}
+        for start in range(0, len(docs), INSERT_BATCH_SIZE):
+            batch = dict(enumerate(docs[start:start + INSERT_BATCH_SIZE], start))
+            with storage_errors():
+                database = await self.engine.connect()
+                existing = {
+                    record[0] for record in await database.fetch_all(
+                        sqlalchemy.select(self.table.c.id).where(
+                            self.table.c.id.in_([doc["id"] for doc in batch.values()]),
+                        ),
+                    )
+                }
+            rows = {}
+            for index, doc in batch.items():
+                if doc["id"] in existing:
+                    failed[index] = DuplicateKeyError(f"Duplicate key id: {doc['id']}")
+                else:
+                    existing.add(doc["id"])
+                    rows[index] = self._document(doc)
+            if not rows:
+                continue
+            try:
+                with storage_errors():
+                    async with database.transaction():
+                        await database.execute(self.table.insert().values(list(rows.values())))
+            except DuplicateKeyError:
+                for index, doc in rows.items():
+                    try:
+                        await self.create(doc)
+                    except DuplicateKeyError as error:
+                        failed[index] = error
+        return failed
+
+    async def update(self, query: dict, update: dict, fields: Sequence[str]) -> Optional[dict]:
+        first = sqlalchemy.select(self.table.c.id).where(self.where(query)).limit(1)
+        values = self._values(update)
+        with storage_errors():
+            database = await self.engine.connect()
+            if self.engine.dialect.full_returning:
+                # one round trip; UPDATE can't LIMIT, so the row is picked by a subquery
+                record = await database.fetch_one(
+                    self.table.update()
+                    .where(self.table.c.id == first.scalar_subquery())
+                    .values(values)
+                    .returning(*self._select(fields).selected_columns),
+                )
+            else:
+                # SQLAlchemy 1.4 can't compile RETURNING for sqlite
+                async with database.transaction():
+                    _id = await database.fetch_val(first.with_for_update())
+                    if _id is None:
+                        return None
+                    await database.execute(self.table.update().where(self.table.c.id == _id).values(values))
+                    record = await database.fetch_one(self._select(fields).where(self.table.c.id == _id))
+        if record is not None:
+            return self._row(record)
+
+    async def update_many(self, operations: Sequence[Tuple[dict, dict]]):
+        """ Every query must select by `id`, so each statement updates one row at most """
+        with storage_errors():
+            database = await self.engine.connect()
+            async with database.transaction():
+                for query, update in operations:
+                    await database.execute(
+                        self.table.update().where(self.where(query)).values(self._values(update)),
+                    )
+
+    async def delete(self, _id: str, fields: Sequence[str]) -> Optional[dict]:
+        with storage_errors():
+            database = await self.engine.connect()
+            async with database.transaction():
+                record = await database.fetch_one(
+                    self._select(fields).where(self.table.c.id == _id).with_for_update(),
+                )
+                if record is None:
+                    return None
+                await database.execute(self.table.delete().where(self.table.c.id == _id))
+        return self._row(record)
+
+    async def create_index(self, keys: IndexKeys, unique: bool = False, collation: Optional[dict] = None):
+        index = self._index(keys, unique, collation)
+        if index is None:
+            return
+        with storage_errors():
+            database = await self.engine.connect()
+            await database.execute(self.engine.ddl(CreateIndex(index, if_not_exists=True)))
+
+    def _index(self, keys: IndexKeys, unique: bool, collation: Optional[dict]) -> Optional[sqlalchemy.Index]:
+        fields = index_fields(keys)
+        if fields == [column.name for column in self.table.primary_key]:
+            return None
+        name = f"ix_{self.table.name}_{'_'.join(fields)}"
+        columns = [self.table.c[field] for field in fields]
+        if _case_insensitive(collation):
+            name = f"{name}_ci"
+            columns = [
+                sqlalchemy.func.lower(column) if isinstance(column.type, sqlalchemy.String) else column
+                for column in columns
+            ]
+        # ascending like the listings, so that the indexes also serve their order
+        directions = [1] if isinstance(keys, str) else [direction for _, direction in keys]
+        columns = [
+            self._ascending(column) if direction == 1 else column.desc()
+            for column, direction in zip(columns, directions)
+        ]
+        return sqlalchemy.Index(name, *columns, unique=unique)
+
+
+class SQLEngine(StorageEngine):
+    """
+    Tables of `metadata`, created on first use. Pool options (`min_size`,
+    `max_size`) are passed to `databases.Database`.
+    """
+
+    def __init__(self, url: str, metadata: sqlalchemy.MetaData, **options):
+        self.url = url
+        self.metadata = metadata
+        self.database = Database(url, **options)
+        self.name = self.database.url.database
+        self.dialect = sqlalchemy.engine.make_url(url).get_dialect()()
+        self._collections: Dict[str, SQLCollection] = {}
+        self._lock: Optional[asyncio.Lock] = None
+
+    def __getitem__(self, name: str) -> SQLCollection:
+        if name not in self._collections:
+            self._collections[name] = SQLCollection(self, self.metadata.tables[name])
+        return self._collections[name]
+
+    async def connect(self) -> Database:
+        if self.database.is_connected:
+            return self.database
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.database.is_connected:
+                await self.database.connect()
+                for table in self.metadata.sorted_tables:
+                    await self.database.execute(self.ddl(CreateTable(table, if_not_exists=True)))
+        return self.database
+
+    def ddl(self, element) -> str:
+        # DDL is compiled upfront, `databases` compiles with query-only options
+        return str(element.compile(dialect=self.dialect))
+
+    async def disconnect(self):
+        if self.database.is_connected:
+            await self.database.disconnect()
+
+    async def drop(self):
+        with storage_errors():
+            database = await self.connect()
+            for table in reversed(self.metadata.sorted_tables):
+                await database.execute(table.delete())
@@ -1,20 +1,33 @@
 import os
 
-import pytest
-from motor.motor_asyncio import AsyncIOMotorClient
+import pytest_asyncio
 
 # This sets `os.environ`,
 # If we placed it below the application import, it would raise an error
 # informing us that 'TESTING' had already been read from the environment.
 os.environ['TESTING'] = 'True'
+# STORAGE_ENGINE=mongo runs the suite against the database container
+os.environ.setdefault('STORAGE_ENGINE', 'memory')
 
-from app.config import settings
+from app import crud
+from app.db import client
+from app.utils.middlewares import principal_cache
+from app.utils.throttling import login_throttle
+from app.utils.user_utils import token_versions
 
 
-@pytest.fixture(scope="function")
-def test_db():
-    client = AsyncIOMotorClient(settings.mongo_uri)
-    db = client[settings.db_name]
+@pytest_asyncio.fixture(scope="function")
+async def test_db():
+    db = client.get_database()
     yield db
-    client = AsyncIOMotorClient(settings.mongo_uri)
-    client.drop_database(settings.db_name)
+    await db.drop()
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clear_caches():
+    yield
+    if crud.user.cache is not None:
+        await crud.user.cache.clear()
+    principal_cache.clear()
+    token_versions.clear()
+    await login_throttle.backend.clear()
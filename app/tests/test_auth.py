@@ -1,11 +1,12 @@
+from unittest.mock import patch
 from uuid import uuid4
 
 import pytest
 from fastapi.testclient import TestClient
-from motor.motor_asyncio import AsyncIOMotorClient
 
 from app.main import app
 from app import crud, schemas
+from app.storage import StorageEngine
 from app.tests.utils import test_user_create
 from app.utils.user_utils import get_hashed_password, create_access_token
 
@@ -21,7 +22,7 @@ def create_user_raw():
 
 
 @pytest.mark.asyncio
-async def test_unauthorized_user(test_db: AsyncIOMotorClient):
+async def test_unauthorized_user(test_db: StorageEngine):
     users_collection = test_db["users"]
     raw_user = create_user_raw()
     await crud.user.create(schemas.CreateUser(**raw_user), users_collection)
@@ -32,7 +33,7 @@ async def test_unauthorized_user(test_db: AsyncIOMotorClient):
 
 
 @pytest.mark.asyncio
-async def test_authorized_user(test_db: AsyncIOMotorClient):
+async def test_authorized_user(test_db: StorageEngine):
     users_collection = test_db["users"]
     raw_user = create_user_raw()
     await crud.user.create(schemas.CreateUser(**raw_user), users_collection)
@@ -42,3 +43,31 @@ async def test_authorized_user(test_db: AsyncIOMotorClient):
 
     assert response.status_code == 200
     assert response.json()["id"] == raw_user["id"]
+
+
+@pytest.mark.asyncio
+async def test_introspect_tokens(test_db: StorageEngine):
+    users_collection = test_db["users"]
+    active, inactive = create_user_raw(), create_user_raw()
+    inactive['is_active'] = False
+    for raw_user in (active, inactive):
+        await crud.user.create(schemas.CreateUser(**raw_user), users_collection)
+    token = create_access_token(active['id'])
+    tokens = [
+        token,
+        "not-a-token",
+        create_access_token(inactive['id']),
+        create_access_token(str(uuid4())),
+        token,
+    ]
+
+    with patch.object(crud.user, "get_principals", wraps=crud.user.get_principals) as get_principals:
+        response = client.post("/users/introspect", json={"tokens": tokens})
+
+    assert response.status_code == 200
+    results = response.json()["tokens"]
+    assert [result["active"] for result in results] == [True, False, False, False, True]
+    assert results[0]["sub"] == active['id']
+    assert results[0]["role"] == active['role']
+    assert results[1] == {"active": False}
+    assert get_principals.await_count == 1
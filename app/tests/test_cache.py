@@ -0,0 +1,30 @@
+from unittest.mock import patch
+
+from app.utils.cache import TTLCache
+
+
+def test_lru_eviction():
+    evicted = []
+    cache = TTLCache(maxsize=2, ttl=60, on_evict=lambda key, value: evicted.append(key))
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert evicted == ["b"]
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_expiry():
+    cache = TTLCache(maxsize=2, ttl=60)
+    with patch("app.utils.cache.time.monotonic", return_value=100.0):
+        cache.set("a", 1, ttl=5)
+        cache.set("b", 2, ttl=0)
+    with patch("app.utils.cache.time.monotonic", return_value=104.0):
+        assert cache.get("a") == 1
+        assert "b" not in cache
+    with patch("app.utils.cache.time.monotonic", return_value=106.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
@@ -0,0 +1,76 @@
+from unittest.mock import patch, AsyncMock, MagicMock
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from app import crud, schemas
+from app.main import app
+from app.storage.motor import MotorCollection
+from app.tests.utils import test_user
+from app.utils.conditional import entity_tag
+from app.utils.user_utils import create_access_token
+
+client = TestClient(app)
+pytest_plugins = ('pytest_asyncio',)
+
+
+def test_get_user_not_modified():
+    user = schemas.RetrieveUser(**test_user, version=3)
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=user)):
+        response = client.get(f"/users/{user.id}")
+        etag = response.headers["ETag"]
+        assert response.status_code == 200
+        assert etag == entity_tag(user)
+        assert response.headers["Last-Modified"] == "Mon, 10 Apr 2023 10:28:48 GMT"
+
+        response = client.get(f"/users/{user.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        response = client.get(
+            f"/users/{user.id}", headers={"If-Modified-Since": "Mon, 10 Apr 2023 10:28:48 GMT"},
+        )
+        assert response.status_code == 304
+
+
+def test_get_users_not_modified():
+    users = [schemas.RetrieveUser(**test_user)]
+
+    with patch.object(crud.user, "get_multi", new=AsyncMock(return_value=users)):
+        etag = client.get("/users").headers["ETag"]
+        assert client.get("/users", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_update_if_match():
+    user = schemas.RetrieveUser(**test_user, version=3)
+    headers = {
+        "Authorization": f"Bearer {create_access_token(user.id)}",
+        "If-Match": entity_tag(user),
+    }
+    mock_update = AsyncMock(return_value=user.copy(update={"version": 4}))
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=user)), \
+            patch.object(crud.user, "update", new=mock_update):
+        response = client.patch("/users", json={"first_name": "Jane"}, headers=headers)
+
+    assert response.status_code == 200
+    assert mock_update.await_args.kwargs == {"expected_version": 3}
+    assert response.headers["ETag"] == f'"{user.id}.4"'
+
+
+@pytest.mark.asyncio
+async def test_update_version_conflict():
+    coll = MagicMock(full_name="test.users")
+    coll.find_one_and_update = AsyncMock(return_value=None)
+    coll.find_one = AsyncMock(return_value={**test_user, "version": 4})
+    users_collection = MotorCollection(coll)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await crud.user.update(
+            test_user['id'], {"first_name": "Jane"}, users_collection, expected_version=3,
+        )
+
+    assert exc_info.value.status_code == 412
+    assert coll.find_one_and_update.await_args.args[0] == {"id": test_user['id'], "version": 3}
@@ -1,17 +1,20 @@
+from unittest.mock import patch, AsyncMock
+
 import pytest
 from fastapi.testclient import TestClient
-from motor.motor_asyncio import AsyncIOMotorClient
 
 from app.main import app
 from app import crud, schemas
-from app.tests.utils import test_user_create
+from app.storage import StorageEngine
+from app.tests.utils import test_user, test_user_create
+from app.utils.user_utils import create_access_token
 
 client = TestClient(app)
 pytest_plugins = ('pytest_asyncio',)
 
 
 @pytest.mark.asyncio
-async def test_create_user(test_db: AsyncIOMotorClient):
+async def test_create_user(test_db: StorageEngine):
     test_user = schemas.CreateUserRequest(**test_user_create)
 
     response = client.post("/users", json=test_user.dict(exclude_unset=True))
@@ -39,3 +42,25 @@ async def test_create_user(test_db: AsyncIOMotorClient):
     assert db_user.last_login is not None
     db_users = await crud.user.get_multi(users_collection)
     assert len(db_users) == 1
+
+
+def test_bulk_create_users():
+    admin = schemas.RetrieveUser(**{**test_user, "role": "admin"})
+    token = create_access_token(admin.id)
+    users = [test_user_create, {**test_user_create, "first_name": "Other"}]
+
+    async def create_many(user_objs, coll):
+        return [schemas.RetrieveUser(**user_obj.dict()) for user_obj in user_objs[1:]], {
+            0: "Duplicate object already exists",
+        }
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=admin)), \
+            patch.object(crud.user, "create_many", new=create_many):
+        response = client.post(
+            "/users/bulk", json={"users": users}, headers={"Authorization": f"Bearer {token}"},
+        )
+
+    assert response.status_code == 200, response.json()
+    body = response.json()
+    assert [user["first_name"] for user in body["created"]] == ["Other"]
+    assert body["errors"] == [{"index": 0, "detail": "Duplicate object already exists"}]
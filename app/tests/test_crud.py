@@ -0,0 +1,165 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from app import crud, schemas
+from app.storage.motor import MotorCollection, projection_for
+from app.tests.utils import test_user
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_update_single_round_trip():
+    coll = MagicMock()
+    coll.find_one_and_update = AsyncMock(return_value={**test_user, "role": "admin"})
+    users_collection = MotorCollection(coll)
+
+    user = await crud.user.update(test_user['id'], schemas.UpdateUser(role="admin"), users_collection)
+
+    assert user.role == schemas.user.UserRole.admin
+    coll.find_one_and_update.assert_awaited_once()
+    query, operations = coll.find_one_and_update.await_args.args
+    assert query == {"id": test_user['id']}
+    assert operations["$set"]["role"] == "admin"
+    assert operations["$inc"] == {"version": 1, "token_version": 1}
+    assert coll.find_one_and_update.await_args.kwargs == {
+        "projection": projection_for(crud.user.fields), "return_document": ReturnDocument.AFTER,
+    }
+
+
+@pytest.mark.asyncio
+async def test_remove_single_round_trip():
+    coll = MagicMock()
+    coll.find_one_and_delete = AsyncMock(return_value=None)
+    users_collection = MotorCollection(coll)
+
+    assert await crud.user.remove(test_user['id'], users_collection) is None
+    coll.find_one_and_delete.assert_awaited_once_with(
+        {"id": test_user['id']}, projection=projection_for(crud.user.fields),
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_uses_projection():
+    coll = MagicMock()
+    coll.find_one = AsyncMock(return_value=dict(test_user))
+    users_collection = MotorCollection(coll)
+
+    user = await crud.user.get(test_user['id'], users_collection)
+
+    assert user.id == test_user['id']
+    projection = coll.find_one.await_args.args[1]
+    assert projection["_id"] == 0
+    assert "hashed_pass" not in projection
+    assert set(projection) - {"_id"} == set(schemas.RetrieveUser.__fields__)
+
+
+@pytest.mark.asyncio
+async def test_create_many_reports_errors_per_item():
+    coll = MagicMock()
+    coll.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [
+        {"index": 1, "code": 11000, "errmsg": "E11000 duplicate key error"},
+    ]}))
+    users_collection = MotorCollection(coll)
+    users = [
+        schemas.CreateUser(**{**test_user, "id": str(index), "hashed_pass": "hash"})
+        for index in range(3)
+    ]
+
+    created, errors = await crud.user.create_many(users, users_collection)
+
+    assert [user.id for user in created] == ["0", "2"]
+    assert errors == {1: "Duplicate object already exists"}
+    assert coll.insert_many.await_args.kwargs == {"ordered": False}
+
+
+@pytest.mark.asyncio
+async def test_read_through_cache():
+    coll = MagicMock(full_name="test.users")
+    coll.find_one = AsyncMock(return_value=None)
+    coll.find_one_and_update = AsyncMock(return_value={**test_user, "role": "admin"})
+    users_collection = MotorCollection(coll)
+
+    assert await crud.user.get(test_user['id'], users_collection) is None
+    assert await crud.user.get(test_user['id'], users_collection) is None
+    # negative lookups are cached too
+    assert coll.find_one.await_count == 1
+
+    await crud.user.update(test_user['id'], {"role": "admin"}, users_collection)
+    coll.find_one.return_value = {**test_user, "role": "admin"}
+    assert (await crud.user.get(test_user['id'], users_collection)).role == "admin"
+    assert (await crud.user.get(test_user['id'], users_collection)).role == "admin"
+    assert coll.find_one.await_count == 2
+    assert crud.user.cache.stats()["memory_bytes"] > 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_gets_share_one_query():
+    async def find_one(*args):
+        await asyncio.sleep(0.01)
+        return dict(test_user)
+
+    coll = MagicMock(full_name="test.users")
+    coll.find_one = AsyncMock(side_effect=find_one)
+    users_collection = MotorCollection(coll)
+
+    users = await asyncio.gather(*(
+        crud.user.get(test_user['id'], users_collection) for _ in range(10)
+    ))
+
+    assert all(user.id == test_user['id'] for user in users)
+    assert coll.find_one.await_count == 1
+    assert crud.user.flights.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_read_racing_an_update_is_not_cached():
+    reading, written = asyncio.Event(), asyncio.Event()
+
+    async def find_one(*args):
+        if not reading.is_set():
+            # the first read started before the update and returns the old user
+            reading.set()
+            await written.wait()
+            return dict(test_user)
+        return {**test_user, "role": "admin"}
+
+    coll = MagicMock(full_name="test.users")
+    coll.find_one = AsyncMock(side_effect=find_one)
+    coll.find_one_and_update = AsyncMock(return_value={**test_user, "role": "admin"})
+    users_collection = MotorCollection(coll)
+
+    stale = asyncio.create_task(crud.user.get(test_user['id'], users_collection))
+    await reading.wait()
+    await crud.user.update(test_user['id'], {"role": "admin"}, users_collection)
+    # arriving after the update, this read doesn't join the stale one
+    fresh = asyncio.create_task(crud.user.get(test_user['id'], users_collection))
+    await asyncio.sleep(0)
+    written.set()
+
+    assert (await stale).role == "simple mortal"
+    assert (await fresh).role == "admin"
+    assert (await crud.user.get(test_user['id'], users_collection)).role == "admin"
+    assert coll.find_one.await_count == 2
+    assert crud.user._generations == {}
+
+
+@pytest.mark.asyncio
+async def test_count():
+    coll = MagicMock(full_name="test.users")
+    coll.estimated_document_count = AsyncMock(return_value=100)
+    coll.count_documents = AsyncMock(return_value=7)
+    users_collection = MotorCollection(coll)
+
+    assert await crud.user.count(users_collection) == 100
+    assert await crud.user.count(users_collection, crud.user.filter()) == 100
+    assert await crud.user.count(users_collection, crud.user.filter(role="admin", last_name="Do")) == 7
+    assert await crud.user.count(users_collection, crud.user.filter(last_name="Do", role="admin")) == 7
+
+    assert coll.estimated_document_count.await_count == 2
+    coll.count_documents.assert_awaited_once()
+    assert coll.count_documents.await_args.kwargs == {"collation": crud.user.filter(last_name="Do").collation}
@@ -0,0 +1,47 @@
+import json
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from fastapi.testclient import TestClient
+
+from app import crud, schemas
+from app.main import app
+from app.tests.utils import test_user
+from app.utils.user_utils import create_access_token
+
+client = TestClient(app)
+
+
+async def users_stream(count):
+    for index in range(count):
+        yield schemas.RetrieveUser(**{**test_user, "id": str(index)})
+
+
+def test_export_users():
+    admin = schemas.RetrieveUser(**{**test_user, "role": "admin"})
+    headers = {"Authorization": f"Bearer {create_access_token(admin.id)}"}
+    mock_iterate = MagicMock(return_value=users_stream(3))
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=admin)), \
+            patch.object(crud.user, "iterate", new=mock_iterate):
+        response = client.get(
+            "/users/export",
+            params={"role": "dev", "is_active": True, "with_cursor": True},
+            headers=headers,
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == ["0", "1", "2"]
+    assert lines[0]["_cursor"] == crud.user.next_cursor(schemas.RetrieveUser(**lines[0]))
+    assert mock_iterate.call_args.args[1].query == {"role": "dev", "is_active": True}
+
+
+def test_export_users_requires_admin():
+    user = schemas.RetrieveUser(**test_user)
+    headers = {"Authorization": f"Bearer {create_access_token(user.id)}"}
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=user)):
+        response = client.get("/users/export", headers=headers)
+
+    assert response.status_code == 403
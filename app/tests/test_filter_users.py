@@ -0,0 +1,77 @@
+from unittest.mock import patch, AsyncMock
+
+import pytest
+from fastapi.testclient import TestClient
+from app import crud, schemas
+from app.config import settings
+from app.db.user import NAME_COLLATION, create_user_index
+from app.main import app
+from app.storage import StorageEngine
+from app.storage.motor import projection_for
+from app.tests.utils import test_user
+
+client = TestClient(app)
+pytest_plugins = ('pytest_asyncio',)
+
+SUPPORTED_FILTERS = [
+    {},
+    {"role": schemas.UserRole.admin},
+    {"is_active": True},
+    {"role": schemas.UserRole.dev, "is_active": False},
+    {"last_name": "do"},
+    {"first_name": "jo"},
+    {"last_name": "do", "first_name": "jo"},
+    {"last_name": "do", "role": schemas.UserRole.admin, "is_active": True},
+]
+
+
+def test_get_users_filters():
+    mock_get_multi = AsyncMock(return_value=[schemas.RetrieveUser(**test_user)])
+
+    with patch.object(crud.user, "get_multi", new=mock_get_multi):
+        response = client.get("/users", params={"role": "admin", "last_name": "Do"})
+
+    assert response.status_code == 200
+    where = mock_get_multi.await_args.kwargs["where"]
+    assert where.query == {"role": "admin", "last_name": {"$gte": "Do", "$lt": "Do\uffff"}}
+    assert where.collation == NAME_COLLATION
+
+
+def winning_plan_stages(plan: dict):
+    yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from winning_plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from winning_plan_stages(child)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(settings.storage_engine != 'mongo', reason="query plans are MongoDB specific")
+@pytest.mark.parametrize("filters", SUPPORTED_FILTERS)
+async def test_filters_use_an_index(test_db: StorageEngine, filters: dict):
+    await create_user_index(test_db)
+    users_collection = test_db["users"].collection
+    await users_collection.insert_many([
+        {**test_user, "id": str(index), "last_name": f"Doe{index}"} for index in range(50)
+    ])
+    where = crud.user.filter(**filters)
+
+    cursor = users_collection.find(
+        where.query, projection_for(crud.user.fields), collation=where.collation,
+    )
+    explain = await cursor.sort([(key, 1) for key in crud.user.sort_keys]).limit(12).explain()
+
+    stages = list(winning_plan_stages(explain["queryPlanner"]["winningPlan"]))
+    assert "COLLSCAN" not in stages, stages
+    assert "IXSCAN" in stages, stages
+
+
+def test_get_users_total_count():
+    with patch.object(crud.user, "get_multi", new=AsyncMock(return_value=[])), \
+            patch.object(crud.user, "count", new=AsyncMock(return_value=42)):
+        response = client.get("/users", params={"is_active": True, "with_total": True})
+        assert "X-Total-Count" not in client.get("/users").headers
+
+    assert response.status_code == 200
+    assert response.headers["X-Total-Count"] == "42"
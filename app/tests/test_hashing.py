@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app import crud, schemas
+from app.tests.utils import test_user
+from app.utils.hashing import (
+    PasswordHasher, calibrate_rounds, get_hashed_password, password_hasher, verify_password,
+)
+from app.utils.user_utils import authenticate_user
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify():
+    hasher = PasswordHasher(workers=1, queue_size=1)
+    hashed = await hasher.hash("test1234")
+
+    assert await hasher.verify("test1234", hashed)
+    assert not await hasher.verify("wrong1234", hashed)
+    stats = hasher.stats()
+    assert stats["hash_latency"]["count"] == 1
+    assert stats["verify_latency"]["count"] == 2
+    assert stats["in_flight"] == 0
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_saturated_hasher_rejects():
+    hasher = PasswordHasher(workers=1, queue_size=0)
+
+    results = await asyncio.gather(
+        hasher.hash("test1234"), hasher.hash("test1234"), return_exceptions=True,
+    )
+
+    assert isinstance(results[0], str)
+    assert isinstance(results[1], HTTPException)
+    assert results[1].status_code == 503
+    assert hasher.stats()["rejected"] == 1
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_verify_dummy():
+    hasher = PasswordHasher(workers=1, queue_size=1)
+
+    assert not await hasher.verify_dummy("test1234")
+    assert hasher.stats()["verify_latency"]["count"] == 1
+    hasher.shutdown()
+
+
+def test_calibrate_rounds():
+    assert calibrate_rounds(target=0.0, min_rounds=4) == 4
+    fast = calibrate_rounds(target=0.02, min_rounds=4)
+    assert 4 <= fast <= calibrate_rounds(target=0.08, min_rounds=4)
+
+
+@pytest.mark.asyncio
+async def test_login_rehashes_password_of_another_cost(test_db):
+    users_collection = test_db["users"]
+    old_hash = get_hashed_password("test1234", rounds=4)
+    user_in = schemas.CreateUser(**{**test_user, "hashed_pass": old_hash})
+    await crud.user.create(user_in, users_collection)
+
+    user = await authenticate_user(test_user["id"], "test1234", users_collection)
+
+    stored = await crud.user.get_with_hash_pass(test_user["id"], users_collection)
+    assert stored.hashed_pass == user.hashed_pass != old_hash
+    assert not password_hasher.needs_rehash(stored.hashed_pass)
+    assert verify_password("test1234", stored.hashed_pass)
+    assert stored.token_version == 0
+
+
+def test_only_cheaper_hashes_need_rehash():
+    cheap = get_hashed_password("test1234", rounds=4)
+    # the cost is only read from the hash, no need to spend it
+    costly = cheap.replace("$04$", "$13$", 1)
+
+    assert password_hasher.needs_rehash(cheap)
+    assert not password_hasher.needs_rehash(costly)
@@ -0,0 +1,44 @@
+from unittest.mock import patch, AsyncMock
+
+from fastapi.testclient import TestClient
+
+from app import crud, schemas
+from app.main import app
+from app.tests.utils import test_user
+from app.utils.metrics import Histogram, request_duration
+
+client = TestClient(app)
+
+
+def test_histogram_render():
+    histogram = Histogram('test_seconds', 'Test.', ('op',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'get')
+    histogram.observe(0.1, 'get')
+    histogram.observe(3, 'get')
+
+    assert histogram.render() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{op="get",le="0.1"} 2',
+        'test_seconds_bucket{op="get",le="1.0"} 2',
+        'test_seconds_bucket{op="get",le="+Inf"} 3',
+        'test_seconds_sum{op="get"} 3.15',
+        'test_seconds_count{op="get"} 3',
+    ]
+
+
+def test_requests_are_labelled_by_route_template():
+    labels = ("GET", "/users/{user_id}/", "200")
+    before = request_duration.count(*labels)
+
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=schemas.RetrieveUser(**test_user))):
+        assert client.get(f"/users/{test_user['id']}/").status_code == 200
+    client.get("/no-such-route")
+
+    assert request_duration.count(*labels) == before + 1
+    assert request_duration.count("GET", "unmatched", "404") >= 1
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/users/{user_id}/",status="200"}' \
+        in response.text
+    assert "# TYPE password_hasher_in_flight gauge" in response.text
@@ -0,0 +1,71 @@
+from unittest.mock import patch, AsyncMock
+
+from fastapi.testclient import TestClient
+
+from app import crud, schemas
+from app.main import app
+from app.tests.utils import test_user
+from app.utils.middlewares import principal_cache
+from app.config import settings
+from app.utils.user_utils import access_token_claims, create_access_token, token_versions
+
+client = TestClient(app)
+
+
+def test_principal_cache():
+    principal_cache.clear()
+    token = create_access_token(test_user['id'])
+    headers = {"Authorization": f"Bearer {token}"}
+    mock_get = AsyncMock(return_value=schemas.RetrieveUser(**test_user))
+
+    with patch.object(crud.user, "get", new=mock_get):
+        assert client.get("/users/profile", headers=headers).status_code == 200
+        assert client.get("/users/profile", headers=headers).status_code == 200
+        # one lookup by the middleware, one per request by the route
+        assert mock_get.await_count == 3
+
+        crud.user._notify(test_user['id'])
+        assert principal_cache.get(token) is None
+        assert client.get("/users/profile", headers=headers).status_code == 200
+        assert mock_get.await_count == 5
+
+
+def test_public_route_skips_authentication():
+    mock_get = AsyncMock(return_value=schemas.RetrieveUser(**test_user))
+    headers = {"Authorization": "Bearer not-a-token"}
+
+    with patch.object(crud.user, "get", new=mock_get):
+        response = client.get(f"/users/{test_user['id']}", headers=headers)
+
+    assert response.status_code == 200
+    assert mock_get.await_count == 1
+
+
+def test_protected_route_rejects_invalid_token():
+    response = client.get("/users/profile", headers={"Authorization": "Bearer not-a-token"})
+
+    assert response.status_code == 401
+
+
+def test_stateless_access_token():
+    principal_cache.clear()
+    token_versions.clear()
+    user = schemas.RetrieveUserWithPass(**test_user, hashed_pass="hash", token_version=3)
+    mock_get = AsyncMock(return_value=schemas.RetrieveUser(**test_user))
+    mock_version = AsyncMock(return_value=3)
+
+    with patch.object(settings, "stateless_access_tokens", True), \
+            patch.object(crud.user, "get", new=mock_get), \
+            patch.object(crud.user, "get_token_version", new=mock_version):
+        token = create_access_token(user.id, access_token_claims(user))
+        response = client.get("/users/profile", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        # the middleware only checked the version, the route did the read
+        assert mock_version.await_count == 1
+        assert mock_get.await_count == 1
+
+        principal_cache.clear()
+        token_versions.clear()
+        mock_version.return_value = 4
+        response = client.get("/users/profile", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 401
@@ -0,0 +1,80 @@
+import pstats
+from unittest.mock import patch, AsyncMock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import crud, schemas
+from app.tests.utils import test_user
+from app.utils.middlewares import JWTAuthenticationMiddleware, principal_cache
+from app.utils.profiling import ProfilingMiddleware
+from app.utils.user_utils import create_access_token
+
+
+def make_profiling(directory) -> ProfilingMiddleware:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    return ProfilingMiddleware(app, directory=str(directory), interval=0.0001)
+
+
+def make_client(directory) -> TestClient:
+    return TestClient(JWTAuthenticationMiddleware(make_profiling(directory)))
+
+
+def request(client: TestClient, role: str, **headers):
+    principal_cache.clear()
+    user = schemas.RetrieveUser(**{**test_user, "role": role})
+    headers["Authorization"] = f"Bearer {create_access_token(test_user['id'])}"
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=user)):
+        return client.get("/ping", headers=headers)
+
+
+def test_admin_request_is_profiled(tmp_path):
+    client = make_client(tmp_path)
+
+    response = request(client, "admin", **{"X-Profile": "sample"})
+    assert response.status_code == 200
+    assert (tmp_path / response.headers["X-Profile-File"]).suffix == ".folded"
+
+    response = request(client, "admin", **{"X-Profile": "cprofile"})
+    assert response.status_code == 200
+    pstats.Stats(str(tmp_path / response.headers["X-Profile-File"]))
+
+
+def test_profiling_requires_admin(tmp_path):
+    client = make_client(tmp_path)
+
+    with patch("app.utils.profiling.StackSampler") as sampler, patch("cProfile.Profile") as profiler:
+        response = request(client, "simple mortal", **{"X-Profile": "sample"})
+        anonymous = client.get("/ping", headers={"X-Profile": "cprofile"})
+
+    assert response.status_code == anonymous.status_code == 403
+    assert "X-Profile-File" not in response.headers
+    assert not list(tmp_path.iterdir())
+    # nothing is profiled before the admin check
+    sampler.assert_not_called()
+    profiler.assert_not_called()
+
+
+def test_one_cprofile_capture_at_a_time(tmp_path):
+    profiling = make_profiling(tmp_path)
+    client = TestClient(JWTAuthenticationMiddleware(profiling))
+
+    with profiling._cprofile_lock:
+        assert request(client, "admin", **{"X-Profile": "cprofile"}).status_code == 409
+        assert request(client, "admin", **{"X-Profile": "sample"}).status_code == 200
+    assert request(client, "admin", **{"X-Profile": "cprofile"}).status_code == 200
+
+
+def test_requests_without_header_are_not_profiled(tmp_path):
+    client = make_client(tmp_path)
+
+    response = request(client, "admin")
+
+    assert response.status_code == 200
+    assert "X-Profile-File" not in response.headers
+    assert not list(tmp_path.iterdir())
@@ -2,8 +2,11 @@ from unittest.mock import patch, AsyncMock
 from fastapi.testclient import TestClient
 
 from app import crud, schemas
+from app.crud.pagination import decode_cursor
+from app.storage.base import keyset_query
 from app.main import app
 from app.tests.utils import test_user
+from app.utils.user_utils import create_access_token
 
 client = TestClient(app)
 
@@ -39,3 +42,67 @@ def test_get_user_by_id():
         assert response.status_code == 200
         user = response.json()
         assert user['id'] == test_user['id']
+
+
+def test_get_unknown_user():
+    with patch.object(crud.user, "get", new=AsyncMock(return_value=None)):
+        response = client.get("/users/unknown-id/")
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+
+
+def test_get_profile_of_removed_user():
+    user = schemas.RetrieveUser(**test_user)
+    headers = {"Authorization": f"Bearer {create_access_token(user.id)}"}
+
+    # removed between authentication and the read
+    with patch.object(crud.user, "get", new=AsyncMock(side_effect=[user, None])):
+        response = client.get("/users/profile/", headers=headers)
+
+    assert response.status_code == 404
+
+
+def test_get_users_next_cursor():
+    mock_response = [schemas.RetrieveUser(**test_user)]
+    mock_get_multi = AsyncMock(return_value=mock_response)
+
+    with patch.object(crud.user, "get_multi", new=mock_get_multi):
+        response = client.get("/users", params={"limit": 1})
+        assert response.status_code == 200
+        next_cursor = response.headers["X-Next-Cursor"]
+
+        response = client.get("/users", params={"limit": 1, "cursor": next_cursor})
+        assert response.status_code == 200
+        assert mock_get_multi.await_args.kwargs["after"] == next_cursor
+
+
+def test_cursor_query():
+    user = schemas.RetrieveUser(**test_user)
+    next_cursor = crud.user.next_cursor(user)
+
+    created_at, user_id = decode_cursor(next_cursor, 2)
+    assert created_at == user.created_at
+    assert keyset_query(crud.user.sort_keys, [created_at, user_id]) == {"$or": [
+        {"created_at": {"$gt": user.created_at}},
+        {"created_at": user.created_at, "id": {"$gt": user.id}},
+    ]}
+
+
+def test_get_users_invalid_cursor():
+    response = client.get("/users", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+
+def test_get_users_by_ids():
+    mock_get_many = AsyncMock(return_value=[schemas.RetrieveUser(**test_user)])
+
+    with patch.object(crud.user, "get_many", new=mock_get_many):
+        response = client.post(
+            "/users/batch-get", json={"ids": [test_user['id'], test_user['id'], "unknown"]},
+        )
+
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [test_user['id']]
+    mock_get_many.assert_awaited_once()
+    assert mock_get_many.await_args.args[0] == [test_user['id'], "unknown"]
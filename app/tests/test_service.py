@@ -0,0 +1,13 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_stats():
+    response = client.get("/stats")
+    assert response.status_code == 200
+    pool = response.json()["mongo_pool"]
+    assert pool["max_pool_size"] > 0
+    assert pool["checked_out"] >= 0
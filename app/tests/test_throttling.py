@@ -0,0 +1,79 @@
+from unittest.mock import patch, AsyncMock
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from app import crud
+from app.main import app
+from app.tests.utils import test_user
+from app.utils.hashing import password_hasher
+from app.utils.throttling import InMemoryRateLimitBackend, LoginThrottle, login_throttle
+
+pytest_plugins = ('pytest_asyncio',)
+
+client = TestClient(app)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    backend = InMemoryRateLimitBackend(maxsize=10)
+
+    assert await backend.take("key", 2, 1.0) == 0
+    assert await backend.take("key", 2, 1.0) == 0
+    assert 0 < await backend.take("key", 2, 1.0) <= 1
+    assert await backend.take("other", 2, 1.0) == 0
+
+
+@pytest.mark.asyncio
+async def test_login_throttle_limits_user_and_ip():
+    throttle = LoginThrottle(
+        InMemoryRateLimitBackend(maxsize=10),
+        user_burst=1, user_per_minute=1, ip_burst=2, ip_per_minute=1,
+    )
+
+    await throttle.check("alice", "10.0.0.1")
+    with pytest.raises(HTTPException) as exc:
+        await throttle.check("alice", "10.0.0.2")
+    assert exc.value.status_code == 429
+    assert int(exc.value.headers["Retry-After"]) >= 1
+
+    await throttle.check("bob", "10.0.0.1")
+    with pytest.raises(HTTPException):
+        await throttle.check("carol", "10.0.0.1")
+    assert throttle.stats()["rejected"] == {"user": 1, "ip": 1}
+
+
+def test_login_throttle_needs_a_refill_rate():
+    with pytest.raises(ValueError):
+        LoginThrottle(
+            InMemoryRateLimitBackend(maxsize=10),
+            user_burst=5, user_per_minute=0, ip_burst=0, ip_per_minute=0,
+        )
+
+
+def test_unknown_user_costs_a_verify():
+    login = {"id": test_user["id"], "password": "test1234"}
+    verify_dummy = AsyncMock(return_value=False)
+
+    with patch.object(crud.user, "get_with_hash_pass", new=AsyncMock(return_value=None)), \
+            patch.object(password_hasher, "verify_dummy", new=verify_dummy):
+        assert client.post("/users/token", json=login).status_code == 401
+
+    verify_dummy.assert_awaited_once_with("test1234")
+
+
+def test_throttled_login_skips_hashing():
+    login = {"id": test_user["id"], "password": "test1234"}
+    capacity, _ = login_throttle.limits["user"]
+    verify_dummy = AsyncMock(return_value=False)
+
+    with patch.object(crud.user, "get_with_hash_pass", new=AsyncMock(return_value=None)), \
+            patch.object(password_hasher, "verify_dummy", new=verify_dummy):
+        for _ in range(capacity):
+            assert client.post("/users/token", json=login).status_code == 401
+        response = client.post("/users/token", json=login)
+
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    assert verify_dummy.await_count == capacity
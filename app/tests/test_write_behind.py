@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import MagicMock, AsyncMock
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from app.storage.motor import MotorCollection
+from app.utils.write_behind import LastLoginBuffer
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_flush_keeps_latest_login():
+    coll = MagicMock(full_name="test.users")
+    coll.bulk_write = AsyncMock()
+    buffer = LastLoginBuffer(lambda: MotorCollection(coll), flush_interval=60, max_size=10)
+
+    buffer.record("1", datetime(2023, 1, 2))
+    buffer.record("1", datetime(2023, 1, 1))
+    buffer.record("2", datetime(2023, 1, 3))
+    await buffer.flush()
+
+    operations = coll.bulk_write.await_args.args[0]
+    assert [op._doc["$max"]["last_login"] for op in operations] == [
+        datetime(2023, 1, 2), datetime(2023, 1, 3),
+    ]
+    assert coll.bulk_write.await_args.kwargs == {"ordered": False}
+    assert buffer.stats()["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_size_threshold_and_drain():
+    coll = MagicMock(full_name="test.users")
+    coll.bulk_write = AsyncMock(side_effect=[AutoReconnect(), None, None])
+    buffer = LastLoginBuffer(lambda: MotorCollection(coll), flush_interval=60, max_size=2)
+    buffer.start()
+
+    buffer.record("1")
+    buffer.record("2")
+    await asyncio.sleep(0.01)
+    # the failed flush kept its logins for the next one
+    assert buffer.stats()["failed_flushes"] == 1
+    assert buffer.stats()["pending"] == 2
+
+    await buffer.stop()
+    assert buffer.stats()["pending"] == 0
+    assert buffer.stats()["flushes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unexpected_error_keeps_flushing():
+    coll = MagicMock(full_name="test.users")
+    coll.bulk_write = AsyncMock(side_effect=[RuntimeError(), None])
+    buffer = LastLoginBuffer(lambda: MotorCollection(coll), flush_interval=0.05, max_size=1)
+    buffer.start()
+
+    buffer.record("1")
+    await asyncio.sleep(0.01)
+    assert buffer.stats()["failed_flushes"] == 1
+    assert buffer.stats()["pending"] == 1
+
+    # retried on the next interval
+    await asyncio.sleep(0.1)
+    assert buffer.stats()["flushes"] == 1
+    assert buffer.stats()["pending"] == 0
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried_on_the_next_interval():
+    coll = MagicMock(full_name="test.users")
+    coll.bulk_write = AsyncMock(side_effect=AutoReconnect())
+    buffer = LastLoginBuffer(lambda: MotorCollection(coll), flush_interval=60, max_size=2)
+    buffer.start()
+
+    buffer.record("1")
+    buffer.record("2")
+    await asyncio.sleep(0.01)
+    assert buffer.stats()["failed_flushes"] == 1
+
+    # still above the threshold, new logins don't retry right away
+    buffer.record("3")
+    buffer.record("4")
+    await asyncio.sleep(0.01)
+    assert buffer.stats()["failed_flushes"] == 1
+    assert buffer.stats()["pending"] == 4
+
+    coll.bulk_write.side_effect = None
+    await buffer.stop()
+    assert buffer.stats()["pending"] == 0
@@ -0,0 +1,37 @@
+import functools
+import inspect
+from typing import Sequence
+
+from starlette.authentication import requires as starlette_requires
+from starlette.requests import Request
+
+from app.utils.middlewares import authenticate_request
+
+
+def requires(
+        scopes: str | Sequence[str],
+        status_code: int = 403,
+        redirect: str = None,
+):
+    """
+    Drop-in replacement of `starlette.authentication.requires` for async
+    endpoints. Resolves the lazily authenticated user of the request before
+    checking the scopes.
+    """
+
+    def decorator(func):
+        check_scopes = starlette_requires(scopes, status_code, redirect)(func)
+        parameters = list(inspect.signature(func).parameters)
+        if 'request' not in parameters:
+            raise Exception(f'No "request" argument on function "{func}"')
+        idx = parameters.index('request')
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            request: Request = kwargs.get('request', args[idx] if idx < len(args) else None)
+            await authenticate_request(request)
+            return await check_scopes(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
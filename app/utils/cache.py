@@ -0,0 +1,163 @@
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    In-process LRU cache with a per-entry expiry. Holds at most `maxsize`
+    entries; the least recently used one is evicted first.
+
+    **Parameters**
+
+    * `maxsize`: Maximum number of entries
+    * `ttl`: Default time to live of an entry in seconds
+    * `on_evict`: Optional callback called with (key, value) whenever an entry
+      leaves the cache, whatever the reason
+    """
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float,
+            on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self._pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        if key in self._data:
+            self._pop(key)
+        self._data[key] = (time.monotonic() + ttl, value)
+        while len(self._data) > self.maxsize:
+            self.evictions += 1
+            self._pop(next(iter(self._data)))
+
+    def delete(self, key: Hashable):
+        if key in self._data:
+            self._pop(key)
+
+    def clear(self):
+        for key in list(self._data):
+            self._pop(key)
+
+    def _pop(self, key: Hashable):
+        _, value = self._data.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# Returned by CacheBackend.get for keys that are not cached. `None` is a
+# valid cached value, used for negative lookups.
+MISSING = object()
+
+
+def approximate_size(value: Any) -> int:
+    """ Shallow size of `value` and of its attributes, in bytes """
+    size = sys.getsizeof(value)
+    attributes = getattr(value, '__dict__', None)
+    if attributes:
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in attributes.items())
+    return size
+
+
+class CacheBackend(ABC):
+    """
+    Interface of the read-through object caches. The default is the
+    in-process `InMemoryCacheBackend`; implement it on top of an external
+    cache to share entries (and invalidations) between workers.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        """ Cached value, or `MISSING` """
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    async def clear(self):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """ Per-worker `TTLCache` based backend, also reporting its approximate memory use """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl, on_evict=self._forget)
+        self.memory = 0
+
+    async def get(self, key: str) -> Any:
+        entry = self._cache.get(key)
+        if entry is None:
+            return MISSING
+        return entry[0]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        size = sys.getsizeof(key) + approximate_size(value)
+        self._cache.set(key, (value, size), ttl)
+        if key in self._cache:
+            self.memory += size
+
+    async def delete(self, key: str):
+        self._cache.delete(key)
+
+    async def clear(self):
+        self._cache.clear()
+
+    def _forget(self, key: str, entry: tuple):
+        self.memory -= entry[1]
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), "memory_bytes": self.memory}
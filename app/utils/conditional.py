@@ -0,0 +1,82 @@
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from fastapi import HTTPException
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app.crud.base import precondition_failed_exception
+
+invalid_if_match_exception = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="If-Match must be an ETag returned by this service",
+    )
+
+
+def entity_tag(obj) -> str:
+    """ Strong ETag of a versioned object, changing with every update """
+    return f'"{obj.id}.{obj.version}"'
+
+
+def list_entity_tag(objs: Iterable) -> str:
+    """ Weak ETag of a list of versioned objects """
+    digest = hashlib.sha1()
+    for obj in objs:
+        digest.update(f'{obj.id}.{obj.version};'.encode())
+    return f'W/"{digest.hexdigest()}"'
+
+
+def last_modified(obj) -> Optional[datetime]:
+    modified = obj.updated_at or obj.created_at
+    if modified is None:
+        return None
+    # naive datetimes are read back from Mongo as UTC
+    return modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def not_modified(request: Request, etag: str, modified: Optional[datetime] = None) -> bool:
+    """ Whether the client copy is current, per `If-None-Match` or else `If-Modified-Since` """
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or etag.removeprefix('W/') in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and modified is not None:
+        try:
+            return modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def conditional_response(
+        request: Request, response: Response, etag: str, modified: Optional[datetime] = None,
+) -> Optional[Response]:
+    """
+    Set the validators on `response`. Returns a bodyless 304 to send instead
+    when the client copy is current, `None` otherwise.
+    """
+    headers = {'ETag': etag}
+    if modified is not None:
+        headers['Last-Modified'] = format_datetime(modified, usegmt=True)
+    if not_modified(request, etag, modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def expected_version(request: Request, _id: str) -> Optional[int]:
+    """ Object version required by the `If-Match` header, if any """
+    if_match = request.headers.get('if-match')
+    if if_match is None or if_match.strip() == '*':
+        return None
+    tag = if_match.strip().removeprefix('W/').strip('"')
+    tag_id, _, version = tag.rpartition('.')
+    if not version.isdigit():
+        raise invalid_if_match_exception
+    if tag_id != _id:
+        raise precondition_failed_exception
+    return int(version)
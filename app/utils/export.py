@@ -0,0 +1,36 @@
+import json
+from typing import AsyncIterator
+
+from pydantic.json import pydantic_encoder
+
+from app.crud.base import CRUDBase
+
+# Lines are buffered up to this size before being written out
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+async def export_ndjson(
+        crud: CRUDBase,
+        objs: AsyncIterator,
+        with_cursor: bool = False,
+) -> AsyncIterator[bytes]:
+    """
+    Serialize `objs` as newline-delimited JSON, yielding chunks of about
+    `EXPORT_CHUNK_SIZE` bytes. With `with_cursor` every line carries a
+    `_cursor` field that can be passed back as `after` to resume after it.
+    """
+    chunk = []
+    size = 0
+    async for obj in objs:
+        data = obj.dict()
+        if with_cursor:
+            data['_cursor'] = crud.next_cursor(obj)
+        line = f'{json.dumps(data, default=pydantic_encoder)}\n'.encode()
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
@@ -0,0 +1,235 @@
+import asyncio
+import math
+import secrets
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+from app.config import settings
+from app.utils.metrics import password_hash_duration
+
+# The cost of new hashes is also the floor: hashes below it are rehashed on
+# login (see `authenticate_user`), costlier ones are kept. Workers calibrated
+# to different costs then converge on the highest one instead of rehashing
+# each other's hashes back and forth.
+password_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.password_hash_rounds,
+    bcrypt__min_rounds=settings.password_hash_rounds,
+)
+# bcrypt costs tried by `calibrate_rounds`
+BCRYPT_MAX_ROUNDS = 16
+CALIBRATION_PROBE_ROUNDS = 8
+hasher_busy_exception = HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many password operations in progress, retry later",
+        headers={"Retry-After": "1"},
+    )
+
+
+def get_hashed_password(password: str, rounds: Optional[int] = None) -> str:
+    if rounds is None:
+        return password_context.hash(password)
+    return password_context.handler().using(rounds=rounds).hash(password)
+
+
+def verify_password(password: str, hashed_pass: str) -> bool:
+    return password_context.verify(password, hashed_pass)
+
+
+@lru_cache(maxsize=4)
+def dummy_hash(rounds: Optional[int] = None) -> str:
+    """ Hash of a random password, with the cost of real ones """
+    return get_hashed_password(secrets.token_urlsafe(16), rounds)
+
+
+def verify_dummy_password(password: str, rounds: Optional[int] = None) -> bool:
+    return verify_password(password, dummy_hash(rounds))
+
+
+def measure_verify(rounds: int, repeat: int = 3) -> float:
+    """ Best time of a bcrypt verify at `rounds`, in seconds """
+    hashed = get_hashed_password("calibration", rounds)
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        verify_password("calibration", hashed)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def calibrate_rounds(target: float, min_rounds: int, max_rounds: int = BCRYPT_MAX_ROUNDS) -> int:
+    """
+    Highest bcrypt cost whose verify takes at most `target` seconds on this
+    machine, but not below `min_rounds`. Every round doubles the work, so the
+    cost is extrapolated from a cheap probe, then checked.
+    """
+    if target <= 0:
+        return min_rounds
+    probe = measure_verify(CALIBRATION_PROBE_ROUNDS)
+    rounds = CALIBRATION_PROBE_ROUNDS + math.floor(math.log2(target / probe))
+    rounds = max(min_rounds, min(max_rounds, rounds))
+    while rounds > min_rounds and measure_verify(rounds, repeat=1) > target:
+        rounds -= 1
+    return rounds
+
+
+class LatencyStats:
+    """ Running count / total / max of operation durations in seconds """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and verification on a worker pool so it never blocks
+    the event loop. At most `workers + queue_size` operations are admitted at
+    once; anything above that is rejected with a 503 right away.
+    """
+
+    def __init__(
+            self,
+            executor: str = 'thread',
+            workers: int = 4,
+            queue_size: int = 64,
+            rounds: Optional[int] = None,
+    ):
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'Unknown password hash executor: {executor}')
+        self.executor_kind = executor
+        # bcrypt cost of new hashes, passed along to process workers
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.rejected = 0
+        self.hash_latency = LatencyStats()
+        self.verify_latency = LatencyStats()
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='password-hasher',
+                )
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    async def _run(self, operation: str, latency: LatencyStats, func, *args):
+        if self.in_flight >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise hasher_busy_exception
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            duration = time.perf_counter() - started
+            latency.observe(duration)
+            password_hash_duration.observe(duration, operation)
+
+    async def hash(self, password: str) -> str:
+        return await self._run('hash', self.hash_latency, get_hashed_password, password, self.rounds)
+
+    async def verify(self, password: str, hashed_pass: str) -> bool:
+        return await self._run('verify', self.verify_latency, verify_password, password, hashed_pass)
+
+    async def verify_dummy(self, password: str) -> bool:
+        """
+        Verify against a throwaway hash, so that a login with an unknown user
+        id costs as much as one with a wrong password
+        """
+        return await self._run(
+            'verify', self.verify_latency, verify_dummy_password, password, self.rounds,
+        )
+
+    @staticmethod
+    def needs_rehash(hashed_pass: str) -> bool:
+        """ Whether a hash was made with a deprecated scheme or below the current cost """
+        return password_context.needs_update(hashed_pass)
+
+    def set_rounds(self, rounds: int):
+        self.rounds = rounds
+        password_context.update(bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds)
+
+    async def calibrate(self, target: float, min_rounds: int) -> int:
+        """ Set the bcrypt cost with `calibrate_rounds`, measured off the event loop """
+        rounds = await asyncio.to_thread(calibrate_rounds, target, min_rounds)
+        self.set_rounds(rounds)
+        return rounds
+
+    async def hash_many(self, passwords: Sequence[str]) -> List[str | HTTPException]:
+        """
+        Hash a batch keeping at most `workers` of its items in flight, so a
+        bulk request doesn't take the whole queue. Items that could not be
+        admitted are returned as the 503 exception instead of a hash.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def hash_one(password: str) -> str:
+            async with semaphore:
+                return await self.hash(password)
+
+        results = await asyncio.gather(
+            *(hash_one(password) for password in passwords), return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, HTTPException):
+                raise result
+        return results
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.executor_kind,
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "rejected": self.rejected,
+            "hash_latency": self.hash_latency.stats(),
+            "verify_latency": self.verify_latency.stats(),
+        }
+
+
+password_hasher = PasswordHasher(
+    executor=settings.password_hash_executor,
+    workers=settings.password_hash_workers,
+    queue_size=settings.password_hash_queue_size,
+    rounds=settings.password_hash_rounds,
+)
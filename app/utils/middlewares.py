@@ -1,11 +1,23 @@
-from starlette.authentication import AuthCredentials, AuthenticationError, BaseUser
+import time
+from functools import partial
+
+from starlette.authentication import AuthCredentials, BaseUser
 from starlette.requests import HTTPConnection
-from typing import Tuple
+from typing import Dict, Optional, Set, Tuple
 
 from jose import JWTError
 from starlette.types import Scope, Receive, Send
 
-from app.utils.user_utils import get_current_user
+from app import crud
+from app.config import settings
+from app.utils.cache import TTLCache
+from app.utils.singleflight import SingleFlight
+from app.utils.user_utils import (
+    check_token_version, credentials_exception, decode_access_token, get_token_user,
+    token_versions,
+)
+
+AUTHENTICATOR_SCOPE_KEY = 'authenticator'
 
 
 class CustomUser(BaseUser):
@@ -49,7 +61,73 @@ class CustomUser(BaseUser):
         return self.id
 
 
+class PrincipalCache:
+    """
+    Access token -> CustomUser cache. An entry lives at most `ttl` seconds and
+    never past the token's `exp`; all entries of a user are dropped when
+    `crud.user` updates or removes that user in this worker.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._cache = TTLCache(maxsize, ttl, on_evict=self._forget)
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[CustomUser]:
+        return self._cache.get(token)
+
+    def set(self, token: str, user: CustomUser, exp: int):
+        self._cache.set(token, user, ttl=exp - time.time())
+        if token in self._cache:
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+
+    def invalidate_user(self, user_id: str):
+        for token in self._tokens_by_user.pop(user_id, ()):
+            self._cache.delete(token)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _forget(self, token: str, user: CustomUser):
+        tokens = self._tokens_by_user.get(user.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.id]
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+principal_cache = PrincipalCache(
+    settings.principal_cache_size,
+    min(settings.principal_cache_ttl, settings.token_version_check_interval)
+    if settings.stateless_access_tokens else settings.principal_cache_ttl,
+)
+crud.user.subscribe(principal_cache.invalidate_user)
+crud.user.subscribe(token_versions.delete)
+# concurrent requests with the same uncached token share one resolution
+principal_flights = SingleFlight()
+
+
+async def authenticate_request(conn: HTTPConnection) -> Tuple[AuthCredentials, BaseUser]:
+    """
+    Resolve `conn.auth` and `conn.user` on first use. Until this is awaited a
+    request is seen as anonymous, so handlers reading `request.user` outside
+    of `app.utils.auth.requires` must call it first.
+    """
+    authenticate = conn.scope.pop(AUTHENTICATOR_SCOPE_KEY, None)
+    if authenticate is not None:
+        conn.scope["auth"], conn.scope["user"] = await authenticate()
+    return conn.scope["auth"], conn.scope["user"]
+
+
 class JWTAuthenticationMiddleware:
+    """
+    Authenticates requests lazily: the token is only decoded and the user
+    loaded when a route protected with `app.utils.auth.requires` (or a call to
+    `authenticate_request`) needs them. Public routes pay nothing for it.
+    """
+
     def __init__(self, app):
         self.app = app
 
@@ -65,7 +143,8 @@ class JWTAuthenticationMiddleware:
             return
         connection = HTTPConnection(scope)
 
-        scope["auth"], scope["user"] = await self.authenticate(connection)
+        scope["auth"], scope["user"] = AuthCredentials(scopes=[]), CustomUser()
+        scope[AUTHENTICATOR_SCOPE_KEY] = partial(self.authenticate, connection)
         await self.app(scope, receive, send)
 
     @staticmethod
@@ -77,16 +156,37 @@ class JWTAuthenticationMiddleware:
         Returns:
             CustomUser: A CustomUser instance with basic attributes
         """
+        cached_user = principal_cache.get(token)
+        if cached_user is not None:
+            return cached_user
+        return await principal_flights.do(
+            token, partial(JWTAuthenticationMiddleware.resolve_user, token),
+        )
+
+    @staticmethod
+    async def resolve_user(token: str) -> CustomUser:
         try:
-            user = await get_current_user(token)
-            return CustomUser(
+            token_data = decode_access_token(token)
+        except JWTError:
+            raise credentials_exception
+        if settings.stateless_access_tokens and token_data.ver is not None:
+            await check_token_version(token_data)
+            custom_user = CustomUser(
+                user_id=token_data.sub,
+                first_name=token_data.first_name,
+                last_name=token_data.last_name,
+                role=token_data.role,
+            )
+        else:
+            user = await get_token_user(token_data)
+            custom_user = CustomUser(
                 user_id=user.id,
                 first_name=user.first_name,
                 last_name=user.last_name,
                 role=user.role,
             )
-        except JWTError:
-            raise AuthenticationError("Invalid token")
+        principal_cache.set(token, custom_user, token_data.exp)
+        return custom_user
 
     async def authenticate(self, conn: HTTPConnection) -> Tuple[AuthCredentials, BaseUser]:
         """
@@ -102,7 +202,7 @@ class JWTAuthenticationMiddleware:
 
         try:
             token = self.get_token_from_header(conn.headers["Authorization"])
-        except KeyError:
+        except (KeyError, ValueError):
             return AuthCredentials(scopes=[]), CustomUser()
 
         user = await self.get_user(token)
@@ -0,0 +1,165 @@
+"""
+On-demand profiling of single requests. With `profiling_enabled`, an admin
+request carrying `X-Profile: sample` (or `cprofile`) is profiled and the
+profile is written under `profiling_dir`; the response names the file in
+`X-Profile-File`.
+
+* `sample`: the event loop thread's stack is sampled every
+  `profiling_sample_interval` seconds and written in the collapsed stack
+  format (`.folded`), ready for flamegraph.pl or speedscope. Time spent
+  waiting on the database shows up under the event loop's `select`.
+* `cprofile`: deterministic `cProfile` statistics (`.prof`), for pstats,
+  snakeviz or flameprof.
+
+Both see every coroutine running on the loop meanwhile, not only the
+profiled request. Without the setting the middleware isn't installed, and
+requests without the header only pay for the header lookup.
+"""
+import cProfile
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.authentication import has_required_scope
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils.middlewares import authenticate_request
+
+PROFILE_HEADER = b'x-profile'
+PROFILE_MODES = ('sample', 'cprofile')
+# same scopes as endpoints protected with `requires(['authenticated', 'admin'])`
+PROFILE_SCOPES = ['authenticated', 'admin']
+
+
+class StackSampler:
+    """ Samples the stack of one thread from a background thread """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'.replace(';', ':')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests with an `X-Profile` header, after checking the admin
+    scope as `app.utils.auth.requires` does; authentication isn't part of the
+    profile. Only one `cprofile` capture runs at a time, others get a 409.
+    Must run inside `JWTAuthenticationMiddleware`, i.e. be added to the app
+    before it.
+    """
+
+    def __init__(self, app: ASGIApp, directory: str, interval: float = 0.001):
+        self.app = app
+        self.directory = directory
+        self.interval = interval
+        self._cprofile_lock = threading.Lock()
+
+    @staticmethod
+    def requested_mode(scope: Scope) -> Optional[str]:
+        for name, value in scope['headers']:
+            if name == PROFILE_HEADER:
+                return value.decode('latin-1').strip().lower() or PROFILE_MODES[0]
+        return None
+
+    def profile_path(self, scope: Scope, mode: str) -> str:
+        name = re.sub(r'[^A-Za-z0-9]+', '_', scope['path']).strip('_') or 'root'
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        extension = 'folded' if mode == 'sample' else 'prof'
+        return os.path.join(self.directory, f'{stamp}-{scope["method"]}-{name}.{extension}')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        mode = self.requested_mode(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        if mode not in PROFILE_MODES:
+            response = JSONResponse({'detail': f'X-Profile must be one of {", ".join(PROFILE_MODES)}'}, 400)
+            await response(scope, receive, send)
+            return
+
+        # checked before profiling starts, so that only admins can start one
+        conn = HTTPConnection(scope)
+        try:
+            await authenticate_request(conn)
+        except HTTPException as exc:
+            await JSONResponse({'detail': exc.detail}, exc.status_code, exc.headers)(scope, receive, send)
+            return
+        if not has_required_scope(conn, PROFILE_SCOPES):
+            await JSONResponse({'detail': 'Forbidden'}, 403)(scope, receive, send)
+            return
+        # cProfile uses the thread's single profile hook, one capture at a time
+        if mode == 'cprofile' and not self._cprofile_lock.acquire(blocking=False):
+            await JSONResponse({'detail': 'A cprofile capture is already running'}, 409)(scope, receive, send)
+            return
+
+        path = self.profile_path(scope, mode)
+
+        async def send_with_profile_file(message: Message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'x-profile-file', os.path.basename(path).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        if mode == 'sample':
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_with_profile_file)
+            finally:
+                sampler.stop()
+                os.makedirs(self.directory, exist_ok=True)
+                sampler.write(path)
+            return
+
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_profile_file)
+            finally:
+                profiler.disable()
+                os.makedirs(self.directory, exist_ok=True)
+                profiler.dump_stats(path)
+        finally:
+            self._cprofile_lock.release()
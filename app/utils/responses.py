@@ -0,0 +1,46 @@
+import typing
+
+from pydantic import BaseModel
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj: typing.Any) -> typing.Any:
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson when it is installed (datetimes and
+    enums natively, pydantic models through `.dict()`), with the stdlib
+    encoder of `JSONResponse` otherwise.
+    """
+
+    def render(self, content: typing.Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def shaped_response(
+        content: typing.Any, response: Response = None, status_code: int = 200,
+) -> FastJSONResponse:
+    """
+    Render trusted content, e.g. CRUD results already matching the route's
+    `response_model`, skipping FastAPI's second validation and encoding pass.
+    Headers set on the injected `response` are carried over.
+    """
+    if isinstance(content, list):
+        content = [obj.dict() if isinstance(obj, BaseModel) else obj for obj in content]
+    elif isinstance(content, BaseModel):
+        content = content.dict()
+    shaped = FastJSONResponse(content, status_code=status_code)
+    if response is not None:
+        shaped.headers.raw.extend(response.headers.raw)
+    return shaped
@@ -0,0 +1,122 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+from app.config import settings
+from app.utils.cache import TTLCache
+
+
+def throttled_exception(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many login attempts, retry later",
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+
+class RateLimitBackend(ABC):
+    """
+    Token buckets by key. The default is the in-process
+    `InMemoryRateLimitBackend`, which limits each worker separately;
+    implement it on top of an external store to share the buckets between
+    workers.
+    """
+
+    @abstractmethod
+    async def take(self, key: str, capacity: int, refill_rate: float) -> float:
+        """
+        Take a token from the bucket `key`, holding at most `capacity` tokens
+        and refilled with `refill_rate` tokens per second. Returns 0 when a
+        token was taken, otherwise the seconds until one is available.
+        """
+
+    @abstractmethod
+    async def clear(self):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """
+    Buckets of at most `maxsize` keys, least recently used dropped first. A
+    bucket is forgotten once it would be full again, as a new one is.
+    """
+
+    def __init__(self, maxsize: int):
+        # key -> (tokens, updated at)
+        self._buckets = TTLCache(maxsize, float('inf'))
+
+    async def take(self, key: str, capacity: int, refill_rate: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill_rate)
+        if tokens < 1:
+            return (1 - tokens) / refill_rate
+        tokens -= 1
+        self._buckets.set(key, (tokens, now), ttl=(capacity - tokens) / refill_rate)
+        return 0.0
+
+    async def clear(self):
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets)}
+
+
+class LoginThrottle:
+    """
+    Limits login attempts per client IP and per user id, so that password
+    guessing can't monopolize the password hasher. Each limit is a bucket of
+    `burst` attempts refilled with `per_minute` attempts a minute, which
+    must be above 0; a burst of 0 disables it. Rejected attempts raise a 429
+    before any password work.
+    """
+
+    def __init__(
+            self,
+            backend: RateLimitBackend,
+            user_burst: int,
+            user_per_minute: float,
+            ip_burst: int,
+            ip_per_minute: float,
+    ):
+        for kind, burst, per_minute in (
+                ("user", user_burst, user_per_minute), ("ip", ip_burst, ip_per_minute),
+        ):
+            if burst > 0 and per_minute <= 0:
+                raise ValueError(f'login_{kind}_per_minute must be above 0 when login_{kind}_burst is set')
+        self.backend = backend
+        self.limits = {
+            "user": (user_burst, user_per_minute / 60),
+            "ip": (ip_burst, ip_per_minute / 60),
+        }
+        self.rejected = {"user": 0, "ip": 0}
+
+    async def check(self, user_id: str, ip: Optional[str]):
+        # the IP is checked first, so one client can't drain other users' buckets
+        for kind, value in (("ip", ip), ("user", user_id)):
+            capacity, refill_rate = self.limits[kind]
+            if not capacity or value is None:
+                continue
+            retry_after = await self.backend.take(f"login:{kind}:{value}", capacity, refill_rate)
+            if retry_after:
+                self.rejected[kind] += 1
+                raise throttled_exception(retry_after)
+
+    def stats(self) -> dict:
+        return {"rejected": dict(self.rejected), **self.backend.stats()}
+
+
+login_throttle = LoginThrottle(
+    InMemoryRateLimitBackend(settings.login_throttle_size),
+    user_burst=settings.login_user_burst,
+    user_per_minute=settings.login_user_per_minute,
+    ip_burst=settings.login_ip_burst,
+    ip_per_minute=settings.login_ip_per_minute,
+)
@@ -1,21 +1,31 @@
+import logging
 import re
+import time
 from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 
 from fastapi import HTTPException
-from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorClient
-from passlib.context import CryptContext
 from jose import jwt, JWTError
+from pymongo.errors import PyMongoError
 from starlette import status
 
 from app import crud, schemas
 from app.config import settings
+from app.db.client import get_database
+from app.storage import Collection, StorageError
+from app.utils.cache import TTLCache
+from app.utils.hashing import get_hashed_password, password_hasher, verify_password
+from app.utils.metrics import jwt_decode_duration
+
+logger = logging.getLogger(__name__)
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+# user id -> current token_version, re-read at most every check interval
+token_versions = TTLCache(settings.principal_cache_size, settings.token_version_check_interval)
 
 
 def password_validation(password):
@@ -27,18 +37,22 @@ def password_validation(password):
     return password
 
 
-def get_hashed_password(password: str) -> str:
-    return password_context.hash(password)
-
+def access_token_claims(user: 'schemas.RetrieveUserWithPass') -> dict:
+    """ Identity claims embedded in access tokens in stateless mode """
+    if not settings.stateless_access_tokens:
+        return {}
+    return {
+        "role": user.role,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "ver": user.token_version,
+    }
 
-def verify_password(password: str, hashed_pass: str) -> bool:
-    return password_context.verify(password, hashed_pass)
 
-
-def create_access_token(uuid: str) -> str:
+def create_access_token(uuid: str, claims: dict = None) -> str:
     expires_delta = datetime.utcnow() + timedelta(minutes=settings.access_token_expires_in)
 
-    to_encode = {"exp": expires_delta, "sub": uuid}
+    to_encode = {**(claims or {}), "exp": expires_delta, "sub": uuid}
     encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, settings.jwt_algorithm)
     return encoded_jwt
 
@@ -51,16 +65,26 @@ def create_refresh_token(uuid: str) -> str:
     return encoded_jwt
 
 
-async def authenticate_user(uuid: str, password: str, coll: AsyncIOMotorCollection):
+async def authenticate_user(uuid: str, password: str, coll: Collection):
     user = await crud.user.get_with_hash_pass(uuid, coll)
     if not user:
+        await password_hasher.verify_dummy(password)
         return False
-    if not verify_password(password, user.hashed_pass):
+    if not await password_hasher.verify(password, user.hashed_pass):
         return False
+    if password_hasher.needs_rehash(user.hashed_pass):
+        try:
+            hashed_pass = await password_hasher.hash(password)
+            await crud.user.rehash_password(user.id, user.hashed_pass, hashed_pass, coll)
+        except (HTTPException, PyMongoError, StorageError):
+            # the login succeeded, the next one will retry
+            logger.exception("Failed to rehash the password of user %s", user.id)
+        else:
+            user.hashed_pass = hashed_pass
     return user
 
 
-async def refresh_token_helper(r_token: str, coll: AsyncIOMotorCollection):
+async def refresh_token_helper(r_token: str, coll: Collection):
     try:
         payload = jwt.decode(
             r_token, settings.jwt_secret_refresh_key, algorithms=[settings.jwt_algorithm],
@@ -70,15 +94,16 @@ async def refresh_token_helper(r_token: str, coll: AsyncIOMotorCollection):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = await crud.user.get(token_data.sub, coll)
+    user = await crud.user.get_with_hash_pass(token_data.sub, coll)
     if user is None:
         raise credentials_exception
 
-    access_token = create_access_token(token_data.sub)
+    access_token = create_access_token(token_data.sub, access_token_claims(user))
     return {"access_token": access_token, "refresh_token": r_token}
 
 
-async def get_current_user(token: str):
+def decode_access_token(token: str) -> 'schemas.TokenPayload':
+    started = time.perf_counter()
     try:
         payload = jwt.decode(
             token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm],
@@ -88,12 +113,75 @@ async def get_current_user(token: str):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-
-    client = AsyncIOMotorClient(settings.mongo_uri)
-    db = client[settings.db_name]
-    coll = db['users']
+    finally:
+        jwt_decode_duration.observe(time.perf_counter() - started)
+    return token_data
+
+
+async def introspect_tokens(tokens: List[str], coll: Collection) -> List[dict]:
+    """
+    Validate access tokens in a batch, with one query for all their users.
+    A token is active when it decodes, its user exists and is active, and a
+    stateless token was issued for the current token_version. Claims are
+    read from the user, so they are current.
+    """
+    decoded: Dict[str, Optional['schemas.TokenPayload']] = {}
+    for token in dict.fromkeys(tokens):
+        try:
+            decoded[token] = decode_access_token(token)
+        except HTTPException:
+            decoded[token] = None
+    subs = list({token_data.sub for token_data in decoded.values() if token_data is not None})
+    principals = await crud.user.get_principals(subs, coll) if subs else {}
+
+    results = []
+    for token in tokens:
+        token_data = decoded[token]
+        principal = principals.get(token_data.sub) if token_data is not None else None
+        if (
+                principal is None
+                or not principal.get("is_active")
+                or (token_data.ver is not None and token_data.ver != principal.get("token_version", 0))
+        ):
+            results.append({"active": False})
+            continue
+        results.append({
+            "active": True,
+            "sub": token_data.sub,
+            "exp": token_data.exp,
+            "role": principal.get("role"),
+            "first_name": principal.get("first_name"),
+            "last_name": principal.get("last_name"),
+        })
+    return results
+
+
+async def get_token_user(token_data: 'schemas.TokenPayload'):
+    coll = get_database()['users']
     user = await crud.user.get(token_data.sub, coll)
 
     if user is None:
         raise credentials_exception
     return user
+
+
+async def check_token_version(token_data: 'schemas.TokenPayload'):
+    """
+    Make sure a stateless token was issued for the current token_version of
+    its user. The version is re-read from the DB at most once per
+    `token_version_check_interval` seconds per user and worker.
+    """
+    version = token_versions.get(token_data.sub)
+    if version is None:
+        coll = get_database()['users']
+        version = await crud.user.get_token_version(token_data.sub, coll)
+        if version is None:
+            raise credentials_exception
+        token_versions.set(token_data.sub, version)
+    if token_data.ver != version:
+        raise credentials_exception
+
+
+async def get_current_user(token: str):
+    token_data = decode_access_token(token)
+    return await get_token_user(token_data)
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from pymongo.errors import PyMongoError
+
+from app import crud
+from app.config import settings
+from app.db.client import get_database
+from app.storage import Collection, StorageError
+from app.utils.hashing import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class LastLoginBuffer:
+    """
+    Write-behind buffer of login timestamps. Logins are recorded in memory
+    and written as one bulk update every `flush_interval` seconds, or as soon
+    as `max_size` users are pending. Timestamps of a failed flush are kept
+    for the next one; the buffer is drained on shutdown.
+    """
+
+    def __init__(
+            self,
+            get_collection: Callable[[], Collection],
+            flush_interval: float,
+            max_size: int,
+    ):
+        self.get_collection = get_collection
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flush_latency = LatencyStats()
+        self._pending: Dict[str, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: str, when: datetime = None):
+        when = when or datetime.utcnow()
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = when
+            # only when the threshold is crossed: above it after a failed
+            # flush, the retry waits for the next interval
+            if len(self._pending) == self.max_size:
+                self._wakeup.set()
+        elif pending < when:
+            self._pending[user_id] = when
+
+    async def flush(self):
+        if not self._pending:
+            return
+        logins, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            await crud.user.update_last_logins(logins, self.get_collection())
+            self.flushes += 1
+        except (PyMongoError, StorageError):
+            logger.exception("Failed to write %d last_login updates", len(logins))
+            self.failed_flushes += 1
+            # retried on the next interval, not right away
+            self._restore(logins)
+        except BaseException:
+            # unexpected errors and cancellation keep the logins as well
+            self._restore(logins)
+            raise
+        finally:
+            self.flush_latency.observe(time.perf_counter() - started)
+
+    def _restore(self, logins: Dict[str, datetime]):
+        for user_id, when in logins.items():
+            pending = self._pending.get(user_id)
+            if pending is None or pending < when:
+                self._pending[user_id] = when
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # the batch is pending again; an unexpected error must not stop the flushes
+                logger.exception("Unexpected error flushing last_login updates")
+                self.failed_flushes += 1
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "max_size": self.max_size,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flush_latency": self.flush_latency.stats(),
+        }
+
+
+last_login_buffer = LastLoginBuffer(
+    lambda: get_database()['users'],
+    flush_interval=settings.last_login_flush_interval,
+    max_size=settings.last_login_buffer_size,
+)